@@ -0,0 +1,83 @@
+"""
+Admission control for Canvas content migrations.
+
+Starting a content migration for every course of a large batch at once trips Canvas throttling, and the signed S3 URLs
+of migrations that wait long in Canvas's queue expire before Canvas downloads them. CanvasAdmission lets import_files
+keep a bounded number of migrations in flight and paces submissions by the request quota Canvas reports on every
+response, so a batch runs as fast as Canvas will sustain.
+"""
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_REMAINING_HEADER = 'X-Rate-Limit-Remaining'
+
+
+def is_rate_limited(status_code, text):
+    return status_code == 403 and 'Rate Limit Exceeded' in (text or '')
+
+
+class CanvasAdmission(object):
+    """
+    Thread safe pacing of content migration submissions. At most limit migrations should be in flight; limit starts at
+    max_in_flight, is halved each time Canvas throttles a request and grows by one for each migration that finishes,
+    up to max_in_flight again. While the X-Rate-Limit-Remaining quota of the latest response is below low_water,
+    submissions are spaced out by up to max_delay seconds, the closer the quota is to running out the longer, and after
+    a throttled request nothing is submitted for max_delay seconds.
+    """
+
+    def __init__(self, max_in_flight, low_water, max_delay):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.limit = self.max_in_flight
+        self.low_water = low_water
+        self.max_delay = max_delay
+        self.remaining = None
+        self.throttled = 0
+        self._throttled_until = 0
+        self._lock = threading.Lock()
+
+    def record_response(self, response):
+        """
+        Notes the quota Canvas reported on a requests response
+        """
+        remaining = response.headers.get(RATE_LIMIT_REMAINING_HEADER)
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        with self._lock:
+            self.remaining = remaining
+
+    def record_throttled(self):
+        with self._lock:
+            self.throttled += 1
+            self.remaining = 0
+            self.limit = max(self.limit // 2, 1)
+            self._throttled_until = time.time() + self.max_delay
+        logger.warning(
+            "Canvas is throttling requests, pausing submissions for %d seconds and allowing %d content migrations "
+            "in flight",
+            self.max_delay,
+            self.limit
+        )
+
+    def record_finished(self):
+        with self._lock:
+            self.limit = min(self.limit + 1, self.max_in_flight)
+
+    def get_delay(self):
+        """
+        Returns the seconds to wait before submitting another content migration
+        """
+        with self._lock:
+            throttled_for = self._throttled_until - time.time()
+            if throttled_for > 0:
+                return throttled_for
+            if self.remaining is None or not self.low_water or self.remaining >= self.low_water:
+                return 0
+            return self.max_delay * (self.low_water - max(self.remaining, 0)) / float(self.low_water)
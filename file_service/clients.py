@@ -0,0 +1,69 @@
+"""
+Lazily created S3 and Canvas clients shared by the management commands.
+
+Nothing connects until a command first needs a client, so --help and argument errors stay cheap. Clients are kept per
+thread. Canvas request contexts must not be used from several threads at once. A boto S3Connection can be, since each
+request takes its own HTTP connection from the connection's thread safe pool, which is how MultipartUploadWriter sends
+the parts of one upload in parallel; S3 connections are kept per thread so each worker keeps its own warm pool.
+Commands run in the same thread reuse their clients, so migrate_files' export_files and import_files share warm
+connections, and worker threads each connect once rather than once per keyword.
+"""
+import logging
+import threading
+
+from django.conf import settings
+
+from boto.s3.connection import S3Connection
+
+from icommons_common.canvas_utils import SessionInactivityExpirationRC
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def connect_s3():
+    """
+    Returns a new S3Connection. AWS_S3_CONNECTION_OPTIONS can point it at a local S3 stand-in.
+    """
+    return S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_ACCESS_KEY, **settings.AWS_S3_CONNECTION_OPTIONS)
+
+
+def get_s3_connection():
+    connection = getattr(_local, 's3_connection', None)
+    if connection is None:
+        logger.debug("Opening S3 connection for thread %s", threading.current_thread().name)
+        connection = _local.s3_connection = connect_s3()
+    return connection
+
+
+def get_bucket(bucket_name):
+    buckets = getattr(_local, 'buckets', None)
+    if buckets is None:
+        buckets = _local.buckets = {}
+    bucket = buckets.get(bucket_name)
+    if bucket is None:
+        bucket = buckets[bucket_name] = get_s3_connection().get_bucket(bucket_name, validate=False)
+    return bucket
+
+
+def get_redis():
+    client = getattr(_local, 'redis', None)
+    if client is None:
+        # Only the work queue needs Redis, so commands that never use it do not need redis installed
+        from redis import StrictRedis
+        client = _local.redis = StrictRedis(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.WORK_QUEUE_REDIS_DB
+        )
+    return client
+
+
+def get_canvas_context():
+    context = getattr(_local, 'canvas_context', None)
+    if context is None:
+        logger.debug("Creating Canvas SDK context for thread %s", threading.current_thread().name)
+        context = _local.canvas_context = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
+    return context
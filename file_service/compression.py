@@ -0,0 +1,72 @@
+"""
+Chooses how each entry of an export archive is compressed. Media and document formats that are already compressed are
+stored as-is, since deflating them again costs CPU time without making the archive smaller. Everything else, such as
+TopicText HTML and legacy office documents, is deflated.
+"""
+import os
+
+from file_service.zip_stream import ZIP_DEFLATED, ZIP_STORED
+
+
+STORED_CONTENT_TYPE_PREFIXES = (
+    'audio/',
+    'image/',
+    'video/',
+)
+
+# Uncompressed formats within STORED_CONTENT_TYPE_PREFIXES
+DEFLATED_CONTENT_TYPES = frozenset([
+    'audio/wav',
+    'audio/x-wav',
+    'image/bmp',
+    'image/svg+xml',
+    'image/tiff',
+    'image/x-ms-bmp',
+])
+
+STORED_CONTENT_TYPES = frozenset([
+    'application/gzip',
+    'application/java-archive',
+    'application/pdf',
+    'application/vnd.ms-cab-compressed',
+    'application/vnd.oasis.opendocument.presentation',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+    'application/x-compressed',
+    'application/x-gzip',
+    'application/x-rar-compressed',
+    'application/x-shockwave-flash',
+    'application/x-zip-compressed',
+    'application/zip',
+])
+
+STORED_EXTENSIONS = frozenset([
+    '.7z', '.aac', '.avi', '.bz2', '.docx', '.epub', '.flac', '.flv', '.gif', '.gz', '.jar', '.jpeg', '.jpg',
+    '.m4a', '.m4v', '.mov', '.mp3', '.mp4', '.mpeg', '.mpg', '.odp', '.ods', '.odt', '.ogg', '.pdf', '.png',
+    '.pptx', '.rar', '.swf', '.tgz', '.webm', '.wma', '.wmv', '.xlsx', '.xz', '.zip',
+])
+
+
+def get_compress_type(file_name, content_type=None):
+    """
+    Returns ZIP_STORED for already compressed content and ZIP_DEFLATED for everything else. The FileNode content type
+    is used when it is known, otherwise the file extension decides.
+    """
+    if content_type:
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type in STORED_CONTENT_TYPES:
+            return ZIP_STORED
+        if content_type in DEFLATED_CONTENT_TYPES:
+            return ZIP_DEFLATED
+        if content_type.startswith(STORED_CONTENT_TYPE_PREFIXES):
+            return ZIP_STORED
+
+    extension = os.path.splitext(file_name or '')[1].lower()
+    if extension in STORED_EXTENSIONS:
+        return ZIP_STORED
+    return ZIP_DEFLATED
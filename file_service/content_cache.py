@@ -0,0 +1,170 @@
+"""
+Export-wide cache of archive entry payloads for shared fs-cow blobs.
+
+Many FileNodes point at the same physical blob, within a site and across cloned course sites. Once a blob is known to
+be shared, the compressed payload written to the archive is also copied to a scratch file. Later references are copied
+from that file into their own archive entries instead of reading, decoding and deflating the blob again. Blobs
+referenced only once are never copied to local disk.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class CachedContent(object):
+    """
+    The payload and zip metadata of an archive entry written from a cached blob
+    """
+
+    def __init__(self, payload_file, crc, file_size, compress_size, compress_type, checksums=None):
+        self.payload_file = payload_file
+        self.crc = crc
+        self.checksums = checksums or {}
+        self.file_size = file_size
+        self.compress_size = compress_size
+        self.compress_type = compress_type
+
+    def open(self):
+        return open(self.payload_file, 'rb')
+
+
+class ContentCacheFill(object):
+    """
+    Collects the payload of an archive entry as it is written. Call commit() with the finished ZipStreamEntry, or
+    abort() if the entry could not be written.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        fd, self.payload_file = tempfile.mkstemp(suffix='.payload', dir=cache.cache_dir)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def commit(self, entry):
+        self._file.close()
+        self.cache._finish_fill(self.key, CachedContent(
+            self.payload_file,
+            entry.crc,
+            entry.file_size,
+            entry.compress_size,
+            entry.compress_type,
+            entry.checksums
+        ))
+
+    def abort(self):
+        self._file.close()
+        _remove(self.payload_file)
+        self.cache._finish_fill(self.key, None)
+
+
+class ContentCache(object):
+    """
+    Thread safe cache of entry payloads keyed by (source file, compress type), where the source file is the storage
+    node location joined with the FileNode's physical location. A blob is only cached once it is known to be shared,
+    either because it appears more than once in an archive or because it was already exported earlier in the run, so
+    a blob shared across keywords is read at its first and second reference and served from the cache after that. The
+    least recently used payloads are evicted once the cache holds more than max_bytes. Payloads are kept in a directory
+    of their own under scratch_dir, so several export processes on a host can each have a cache.
+    """
+
+    def __init__(self, scratch_dir, max_bytes):
+        try:
+            os.makedirs(scratch_dir)
+        except os.error:
+            pass
+        self.cache_dir = tempfile.mkdtemp(prefix='content_cache_', dir=scratch_dir)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lookups = 0
+        self.hits = 0
+        self.bytes_reused = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._filling = {}
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        if not self.lookups:
+            return 0.0
+        return 100.0 * self.hits / self.lookups
+
+    def get(self, key, shared=False):
+        """
+        Returns (CachedContent, None) when key is cached, (None, ContentCacheFill) when the caller should export the
+        blob and fill the cache as it goes, or (None, None) when the blob should just be exported. shared is set when
+        the caller knows of another reference to the blob. Waits while another thread is filling key so the blob is
+        not read twice.
+        """
+        while True:
+            with self._lock:
+                cached = self._entries.get(key)
+                if cached is not None:
+                    self._entries[key] = self._entries.pop(key)
+                    self.lookups += 1
+                    self.hits += 1
+                    self.bytes_reused += cached.file_size
+                    return cached, None
+
+                filled = self._filling.get(key)
+                if filled is None:
+                    self.lookups += 1
+                    if not (shared or key in self._seen):
+                        self._seen.add(key)
+                        return None, None
+                    self._filling[key] = threading.Event()
+                    return None, ContentCacheFill(self, key)
+            filled.wait()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def log_stats(self):
+        logger.info(
+            "Content cache: %d of %d blob lookups served from cache (%.1f%%), %d bytes not re-read, "
+            "%d payloads evicted",
+            self.hits,
+            self.lookups,
+            self.hit_rate,
+            self.bytes_reused,
+            self.evictions
+        )
+
+    def _finish_fill(self, key, cached):
+        evicted = []
+        with self._lock:
+            if cached is not None and cached.compress_size <= self.max_bytes:
+                self._entries[key] = cached
+                self.size += cached.compress_size
+                while self.size > self.max_bytes:
+                    _, old = self._entries.popitem(last=False)
+                    self.size -= old.compress_size
+                    self.evictions += 1
+                    evicted.append(old.payload_file)
+            elif cached is not None:
+                evicted.append(cached.payload_file)
+            self._filling.pop(key).set()
+
+        # Readers with the file already open are unaffected by the unlink
+        for payload_file in evicted:
+            _remove(payload_file)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,354 @@
+import csv
+import logging
+import os
+from collections import Counter, defaultdict, OrderedDict
+
+from django.conf import settings
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Length
+
+from kitchen.text.converters import to_bytes, to_unicode
+
+from icommons_common.models import Topic
+
+from file_service.models import FileRepository, FileNode, TopicText
+
+
+logger = logging.getLogger(__name__)
+
+# Oracle rejects IN lists with more than 1000 expressions (ORA-01795)
+MAX_IN_LIST_SIZE = 1000
+
+
+def get_file_repository_id(topic_id):
+    return "icb.topic%s.files" % topic_id
+
+
+def get_exported_topics():
+    return Topic.objects.exclude(
+        Q(tool_id__in=settings.EXPORT_FILES_EXCLUDED_TOOL_IDS) |
+        Q(title__in=settings.EXPORT_FILES_EXCLUDED_TOPIC_TITLES)
+    )
+
+
+class TopicExport(object):
+    """
+    A topic with the file repository, file nodes and topic text exported for it. TopicTexts are loaded without their
+    source_text, which is streamed by iter_topic_texts() when the archive is written.
+    """
+
+    def __init__(self, plan, topic, file_repository, file_nodes, topic_texts):
+        self.plan = plan
+        self.topic = topic
+        self.file_repository = file_repository
+        self.file_nodes = file_nodes
+        self.topic_texts = topic_texts
+
+    @property
+    def title(self):
+        if self.topic.title:
+            return self.topic.title.strip().replace(' ', '_')
+        return 'no_title_%s' % self.topic.topic_id
+
+    def get_file_node_arcname(self, file_node):
+        return to_bytes(os.path.join(
+            self.plan.archive_root,
+            to_unicode(self.title),
+            to_unicode(file_node.file_path.lstrip('/')),
+            to_unicode(file_node.file_name.lstrip('/'))
+        ))
+
+    def get_topic_text_arcname(self, topic_text):
+        return to_bytes(os.path.join(
+            self.plan.archive_root,
+            to_unicode(self.title),
+            to_unicode(topic_text.name.lstrip('/'))
+        ))
+
+    @property
+    def size(self):
+        """
+        Estimated uncompressed size of the topic's archive entries
+        """
+        return (
+            sum(file_node.file_size or 0 for file_node in self.file_nodes) +
+            sum(topic_text.source_text_length or 0 for topic_text in self.topic_texts)
+        )
+
+    def iter_topic_texts(self):
+        """
+        Yields (TopicText, source_text) pairs, fetching source_text a row at a time so only one is in memory
+        """
+        topic_texts = dict((topic_text.text_id, topic_text) for topic_text in self.topic_texts)
+        for ids in _chunks(list(topic_texts)):
+            for text_id, source_text in TopicText.objects.filter(text_id__in=ids).values_list(
+                'text_id', 'source_text'
+            ).iterator():
+                yield topic_texts[text_id], source_text
+
+    def split(self, max_bytes):
+        """
+        Splits a topic that is too big for a single archive part into TopicExports of at most max_bytes each, on file
+        boundaries. Files bigger than max_bytes get a TopicExport of their own.
+        """
+        topic_exports = []
+        file_nodes = []
+        size = 0
+        for file_node in self.file_nodes:
+            if file_nodes and size + (file_node.file_size or 0) > max_bytes:
+                topic_exports.append(TopicExport(self.plan, self.topic, self.file_repository, file_nodes, []))
+                file_nodes = []
+                size = 0
+            file_nodes.append(file_node)
+            size += file_node.file_size or 0
+        topic_exports.append(TopicExport(self.plan, self.topic, self.file_repository, file_nodes, self.topic_texts))
+        return topic_exports
+
+
+class ArchivePart(object):
+    """
+    The topics written to one archive for a keyword. Keywords that fit in a single archive are exported to
+    <keyword>.zip, larger keywords to <keyword>.part1.zip, <keyword>.part2.zip and so on.
+    """
+
+    def __init__(self, plan, number):
+        self.plan = plan
+        self.number = number
+        self.part_count = 1
+        self.topic_exports = []
+        self.size = 0
+
+    @property
+    def key_name(self):
+        if self.part_count == 1:
+            return "%s.zip" % self.plan.keyword
+        return "%s.part%d.zip" % (self.plan.keyword, self.number)
+
+    @property
+    def includes_readme(self):
+        return self.number == 1
+
+    def add(self, topic_export, size):
+        self.topic_exports.append(topic_export)
+        self.size += size
+
+
+class KeywordExportPlan(object):
+    """
+    Everything exported for an iSite, loaded with a fixed number of set based queries instead of several queries per
+    topic. Rows are streamed from the cursor with iterator(), so Django does not also cache every row, and grouped in
+    memory by topic, so a plan holds every FileNode of the keyword. TopicText source_text is left in the database until
+    it is written.
+    """
+
+    def __init__(self, keyword):
+        self.keyword = keyword
+        self.topic_exports = []
+        self.query_count = 0
+
+    @property
+    def archive_root(self):
+        return to_unicode(settings.CANVAS_IMPORT_FOLDER_PREFIX + self.keyword)
+
+    @property
+    def readme_arcname(self):
+        return to_bytes(os.path.join(self.archive_root, settings.EXPORT_FILES_README_FILENAME))
+
+    @classmethod
+    def load(cls, keyword, site):
+        plan = cls(keyword)
+        topics = list(plan._iterate(get_exported_topics().filter(site=site).only(
+            'topic_id', 'title'
+        )))
+        logger.info('Attempting to export files for %d topics', len(topics))
+
+        file_repository_ids = [get_file_repository_id(topic.topic_id) for topic in topics]
+        file_repositories = {}
+        for ids in _chunks(file_repository_ids):
+            for file_repository in plan._iterate(FileRepository.objects.select_related('storage_node').only(
+                'file_repository_id', 'storage_node'
+            ).filter(file_repository_id__in=ids)):
+                file_repositories[file_repository.file_repository_id] = file_repository
+
+        file_nodes = defaultdict(list)
+        for ids in _chunks(list(file_repositories)):
+            for file_node in plan._iterate(FileNode.objects.filter(
+                file_repository__in=ids,
+                file_type='file'
+            ).select_related('storage_node').only(
+                'file_node_id', 'file_repository', 'file_type', 'storage_node', 'physical_location', 'file_path',
+                'file_name', 'encoding', 'file_size', 'content_type', 'last_modified'
+            )):
+                file_nodes[file_node.file_repository_id].append(file_node)
+
+        topic_texts = defaultdict(list)
+        topic_ids = [topic.topic_id for topic in topics]
+        for ids in _chunks(topic_ids):
+            for topic_text in plan._iterate(TopicText.objects.filter(topic_id__in=ids).only(
+                'text_id', 'topic_id', 'name', 'modified_on'
+            ).annotate(
+                source_text_length=Length('source_text')
+            )):
+                topic_texts[topic_text.topic_id].append(topic_text)
+
+        for topic, file_repository_id in zip(topics, file_repository_ids):
+            file_repository = file_repositories.get(file_repository_id)
+            if file_repository is None:
+                logger.info("FileRepository does not exist for %s", file_repository_id)
+                continue
+            plan.topic_exports.append(TopicExport(
+                plan,
+                topic,
+                file_repository,
+                file_nodes[file_repository_id],
+                topic_texts[topic.topic_id]
+            ))
+
+        logger.info(
+            "Loaded export plan for keyword %s with %d queries: %d topics, %d file repositories, %d files, "
+            "%d topic texts",
+            keyword,
+            plan.query_count,
+            len(topics),
+            len(file_repositories),
+            sum(len(nodes) for nodes in file_nodes.values()),
+            sum(len(texts) for texts in topic_texts.values())
+        )
+        return plan
+
+    def split(self, max_bytes):
+        """
+        Groups the topics into ArchiveParts whose estimated size, from FileNode.file_size, stays under max_bytes.
+        Parts are split on topic boundaries unless a single topic is bigger than max_bytes. A max_bytes of 0 puts
+        everything in one part.
+        """
+        parts = [ArchivePart(self, 1)]
+        for topic_export in self.topic_exports:
+            size = topic_export.size
+            if max_bytes and size > max_bytes:
+                topic_exports = topic_export.split(max_bytes)
+            else:
+                topic_exports = [topic_export]
+
+            for topic_export in topic_exports:
+                size = topic_export.size
+                part = parts[-1]
+                if max_bytes and part.topic_exports and part.size + size > max_bytes:
+                    part = ArchivePart(self, len(parts) + 1)
+                    parts.append(part)
+                part.add(topic_export, size)
+
+        for part in parts:
+            part.part_count = len(parts)
+        if len(parts) > 1:
+            logger.info(
+                "Split export for keyword %s into %d archives of up to %d bytes: %s",
+                self.keyword,
+                len(parts),
+                max_bytes,
+                ', '.join("%s (%d bytes)" % (part.key_name, part.size) for part in parts)
+            )
+        return parts
+
+    def _iterate(self, query_set):
+        self.query_count += 1
+        return query_set.iterator()
+
+
+class KeywordSizeEstimate(object):
+    """
+    Totals of what an export of keyword would copy, from the database alone. storage_node is the physical_location
+    of the storage node holding most of the keyword's bytes.
+    """
+    FIELDS = ('keyword', 'topics', 'files', 'file_size', 'disk_size', 'storage_node')
+
+    def __init__(self, keyword, topics=0, files=0, file_size=0, disk_size=0, storage_node=None):
+        self.keyword = keyword
+        self.topics = topics
+        self.files = files
+        self.file_size = file_size
+        self.disk_size = disk_size
+        self.storage_node = storage_node
+
+    @classmethod
+    def estimate(cls, keywords):
+        """
+        Returns estimates for keywords, largest first, aggregating FileNode sizes in the database with one query per
+        1000 keywords and one per 1000 file repositories. Nothing is read from the storage nodes.
+        """
+        estimates = OrderedDict((keyword, cls(keyword)) for keyword in keywords)
+        file_repository_keywords = {}
+        for ids in _chunks(list(estimates)):
+            for topic_id, keyword in get_exported_topics().filter(site__keyword__in=ids).values_list(
+                'topic_id', 'site__keyword'
+            ):
+                file_repository_keywords[get_file_repository_id(topic_id)] = keyword
+                estimates[keyword].topics += 1
+
+        storage_node_sizes = defaultdict(Counter)
+        for ids in _chunks(list(file_repository_keywords)):
+            for row in FileNode.objects.filter(file_repository__in=ids, file_type='file').values(
+                'file_repository',
+                'storage_node__physical_location',
+                'file_repository__storage_node__physical_location'
+            ).annotate(
+                files=Count('file_node_id'),
+                file_size=Sum('file_size'),
+                disk_size=Sum('disk_size')
+            ).order_by():
+                keyword = file_repository_keywords[row['file_repository']]
+                estimate = estimates[keyword]
+                estimate.files += row['files']
+                estimate.file_size += row['file_size'] or 0
+                estimate.disk_size += row['disk_size'] or 0
+                # File nodes without a storage node of their own are read from their repository's
+                storage_node = (
+                    row['storage_node__physical_location'] or row['file_repository__storage_node__physical_location']
+                )
+                storage_node_sizes[keyword][storage_node] += row['disk_size'] or 0
+
+        for keyword, sizes in storage_node_sizes.items():
+            estimates[keyword].storage_node = sizes.most_common(1)[0][0]
+        return sorted(estimates.values(), key=lambda e: e.file_size, reverse=True)
+
+    @classmethod
+    def interleave_storage_nodes(cls, estimates):
+        """
+        Returns estimates reordered so consecutive keywords are read from different storage nodes where possible,
+        taking the largest remaining keyword of each node in turn. Workers that start consecutive keywords then spread
+        their reads over the nodes instead of queueing for one node while the others are idle.
+        """
+        by_storage_node = OrderedDict()
+        for estimate in estimates:
+            by_storage_node.setdefault(estimate.storage_node, []).append(estimate)
+
+        ordered = []
+        queues = list(by_storage_node.values())
+        while queues:
+            for queue in queues:
+                ordered.append(queue.pop(0))
+            queues = [queue for queue in queues if queue]
+        return ordered
+
+    @classmethod
+    def read_plan_file(cls, path):
+        with open(path, 'rU') as plan_file:
+            # Plan files written before storage_node was recorded have no storage_node column
+            return [
+                cls(row['keyword'], int(row['topics']), int(row['files']), int(row['file_size']),
+                    int(row['disk_size']), row.get('storage_node') or None)
+                for row in csv.DictReader(plan_file)
+            ]
+
+    @classmethod
+    def write_plan_file(cls, path, estimates):
+        with open(path, 'wb') as plan_file:
+            writer = csv.writer(plan_file)
+            writer.writerow(cls.FIELDS)
+            for estimate in estimates:
+                writer.writerow([getattr(estimate, field) for field in cls.FIELDS])
+
+
+def _chunks(values, size=MAX_IN_LIST_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
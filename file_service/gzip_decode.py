@@ -0,0 +1,238 @@
+"""
+Decoding for FileNodes stored with encoding='gzip'.
+
+GzipChunkReader decodes a source in fixed size chunks, which is much faster than iterating a GzipFile line by line for
+binary content without line breaks. GzipDecodePool decodes large sources in worker processes ahead of the archive
+writer so decompression is not serialized on the export thread.
+"""
+import gzip
+import multiprocessing
+import os
+import tempfile
+import zlib
+from collections import deque
+
+
+class GzipChunkReader(object):
+    """
+    Read only file object returning the decoded contents of a gzip file, decoded by GzipFile buffer_size bytes at a
+    time. Concatenated gzip members are decoded in sequence, as gzip -d does. Corrupt or truncated data, including a
+    missing or wrong CRC and size trailer, raises IOError.
+    """
+
+    def __init__(self, path, buffer_size):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._file = gzip.GzipFile(path, 'rb')
+        self._eof = False
+        # Decode the first chunk up front so a source that is not gzip data fails before anything is written
+        try:
+            self._pending = self._decode_next()
+        except IOError:
+            self._file.close()
+            raise
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._pending]
+            self._pending = b''
+            while not self._eof:
+                chunks.append(self._decode_next())
+            return b''.join(chunks)
+
+        # Short reads are fine for our callers, so only decode more once the current chunk has been consumed
+        if not self._pending and not self._eof:
+            self._pending = self._decode_next()
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def _decode_next(self):
+        try:
+            data = self._file.read(self.buffer_size)
+        except (EOFError, zlib.error) as e:
+            # GzipFile raises EOFError for a source cut short on Python 3
+            raise IOError("Failed to decode gzip file %s: %s" % (self.path, e))
+        if not data:
+            self._eof = True
+        return data
+
+
+def decode_gzip_file(source_file, dest_file, buffer_size):
+    """
+    Decodes source_file into dest_file and returns the decoded size. Runs in GzipDecodePool worker processes.
+    """
+    reader = GzipChunkReader(source_file, buffer_size)
+    decoded_size = 0
+    try:
+        with open(dest_file, 'wb') as d_file:
+            while True:
+                data = reader.read(buffer_size)
+                if not data:
+                    break
+                d_file.write(data)
+                decoded_size += len(data)
+    finally:
+        reader.close()
+    return decoded_size
+
+
+def _decode_gzip_file_in_worker(source_file, dest_file, buffer_size):
+    """
+    Returns (decoded size, None), or (None, error message) if the decode failed, so apply_async callbacks run either way
+    """
+    try:
+        return decode_gzip_file(source_file, dest_file, buffer_size), None
+    except Exception as e:
+        return None, "%s" % e
+
+
+class PendingDecode(object):
+    """
+    A source being decoded into a scratch file by a GzipDecodePool worker
+    """
+
+    def __init__(self, source_file, decoded_file, result):
+        self.source_file = source_file
+        self.decoded_file = decoded_file
+        self.result = result
+
+    def open(self):
+        """
+        Waits for the decode to finish and returns the decoded file opened for reading. The scratch file is unlinked
+        straight away and disappears when the returned file is closed. Raises IOError if the decode failed.
+        """
+        try:
+            decoded_size, error = self.result.get()
+            if error is not None:
+                raise IOError(error)
+            return open(self.decoded_file, 'rb')
+        finally:
+            self.discard()
+
+    def discard(self):
+        try:
+            os.remove(self.decoded_file)
+        except OSError:
+            pass
+
+
+class GzipDecodePool(object):
+    """
+    Decodes gzip sources into scratch files using a pool of worker processes. Safe to share between export threads.
+    """
+
+    def __init__(self, processes, buffer_size, scratch_dir):
+        self.buffer_size = buffer_size
+        self.scratch_dir = scratch_dir
+        try:
+            os.makedirs(scratch_dir)
+        except os.error:
+            pass
+        self.pool = multiprocessing.Pool(processes)
+
+    def decode_async(self, source_file, callback=None):
+        """
+        Starts decoding source_file. callback, if given, is called with (decoded size, error message) from the pool's
+        result thread once the worker is done.
+        """
+        fd, decoded_file = tempfile.mkstemp(suffix='.gunzip', dir=self.scratch_dir)
+        os.close(fd)
+        result = self.pool.apply_async(
+            _decode_gzip_file_in_worker,
+            (source_file, decoded_file, self.buffer_size),
+            callback=callback
+        )
+        return PendingDecode(source_file, decoded_file, result)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class GzipPrefetcher(object):
+    """
+    Submits large gzip sources to a GzipDecodePool ahead of the archive writer, in the order the writer will need
+    them. At most window decodes are outstanding at a time, which bounds the scratch space used. With a
+    StorageNodeScheduler, a decode is only started when its storage node has a free read slot, and the slot is held
+    until the worker has finished reading the source.
+    """
+
+    def __init__(self, decode_pool, sources, window, scheduler=None):
+        """
+        sources is a list of (key, storage node location, source_file) tuples in the order they will be opened
+        """
+        self.decode_pool = decode_pool
+        self.window = max(window, 1)
+        self.scheduler = scheduler
+        self._queue = deque(sources)
+        self._pending = {}
+        self._cancelled = set()
+        self._fill()
+
+    def open(self, key):
+        """
+        Returns the decoded file for key, or None if key was not prefetched
+        """
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            # Not started yet, the caller reads the source itself
+            self._cancelled.add(key)
+            self._fill()
+            return None
+        self._fill()
+        return pending.open()
+
+    def discard(self, key):
+        """
+        Drops the decode for a key that will not be opened after all
+        """
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            self._cancelled.add(key)
+            return
+        try:
+            pending.result.wait()
+        finally:
+            pending.discard()
+        self._fill()
+
+    def close(self):
+        for pending in self._pending.values():
+            try:
+                pending.result.wait()
+            finally:
+                pending.discard()
+        self._pending = {}
+        self._queue.clear()
+
+    def _fill(self):
+        while self._queue and len(self._pending) < self.window:
+            key, location, source_file = self._queue[0]
+            if key in self._cancelled:
+                self._queue.popleft()
+                self._cancelled.discard(key)
+                continue
+
+            callback = None
+            if self.scheduler is not None:
+                slot = self.scheduler.try_acquire(location)
+                if slot is None:
+                    # Retried on the next open() or discard()
+                    return
+                callback = _release_slot_callback(slot)
+            self._queue.popleft()
+            try:
+                self._pending[key] = self.decode_pool.decode_async(source_file, callback)
+            except Exception:
+                if callback is not None:
+                    slot.release()
+                raise
+
+
+def _release_slot_callback(slot):
+    def release(result):
+        slot.release(bytes_read=result[0] or 0)
+    return release
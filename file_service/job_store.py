@@ -0,0 +1,147 @@
+"""
+Local SQLite record of migration progress.
+
+export_files and import_files otherwise only track their work in memory, so a batch that dies part way loses it, and
+a rerun exports everything again and submits Canvas content migrations that are already running. JobStore records
+each keyword's export state and uploaded archives, and each Canvas import's state and the progress URL of every content
+migration, as soon as they change. With --resume, the commands skip what a previous run finished and pick up polling
+the content migrations it left running.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Export states
+EXPORTING = 'exporting'
+EXPORTED = 'exported'
+UNCHANGED = 'unchanged'
+# Import and content migration states
+IMPORTING = 'importing'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS export (
+    keyword TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archive (
+    keyword TEXT NOT NULL,
+    key_name TEXT NOT NULL,
+    etag TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (keyword, key_name)
+);
+CREATE TABLE IF NOT EXISTS import (
+    keyword TEXT NOT NULL,
+    canvas_course_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (keyword, canvas_course_id)
+);
+CREATE TABLE IF NOT EXISTS migration (
+    keyword TEXT NOT NULL,
+    canvas_course_id TEXT NOT NULL,
+    key_name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    progress_url TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (keyword, canvas_course_id, key_name)
+);
+"""
+
+
+class JobStore(object):
+    """
+    Thread safe job state store in the SQLite database at path. Every change is committed straight away.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        # Autocommit, the lock serializes use of the connection across export worker threads
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(SCHEMA)
+        logger.info("Recording migration job state in %s", path)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_export_state(self, keyword):
+        row = self._fetch_one("SELECT state FROM export WHERE keyword = ?", (keyword,))
+        return row[0] if row else None
+
+    def set_export_state(self, keyword, state, error=None):
+        self._execute(
+            "INSERT OR REPLACE INTO export (keyword, state, error, updated) VALUES (?, ?, ?, ?)",
+            (keyword, state, error, time.time())
+        )
+
+    def record_archive(self, keyword, key_name, etag):
+        self._execute(
+            "INSERT OR REPLACE INTO archive (keyword, key_name, etag, updated) VALUES (?, ?, ?, ?)",
+            (keyword, key_name, etag, time.time())
+        )
+
+    def get_import_state(self, keyword, canvas_course_id):
+        row = self._fetch_one(
+            "SELECT state FROM import WHERE keyword = ? AND canvas_course_id = ?",
+            (keyword, str(canvas_course_id))
+        )
+        return row[0] if row else None
+
+    def set_import_state(self, keyword, canvas_course_id, state):
+        self._execute(
+            "INSERT OR REPLACE INTO import (keyword, canvas_course_id, state, updated) VALUES (?, ?, ?, ?)",
+            (keyword, str(canvas_course_id), state, time.time())
+        )
+
+    def get_migrations(self, keyword, canvas_course_id):
+        """
+        Returns {key_name: (state, progress_url)} for the content migrations of an import
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key_name, state, progress_url FROM migration WHERE keyword = ? AND canvas_course_id = ?",
+                (keyword, str(canvas_course_id))
+            ).fetchall()
+        return dict((key_name, (state, progress_url)) for key_name, state, progress_url in rows)
+
+    def set_migration_state(self, keyword, canvas_course_id, key_name, state, progress_url):
+        self._execute(
+            "INSERT OR REPLACE INTO migration (keyword, canvas_course_id, key_name, state, progress_url, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (keyword, str(canvas_course_id), key_name, state, progress_url, time.time())
+        )
+
+    def _execute(self, sql, params):
+        with self._lock:
+            self._connection.execute(sql, params)
+
+    def _fetch_one(self, sql, params):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchone()
+
+
+def open_job_store():
+    """
+    Returns a JobStore at MIGRATION_JOB_STORE, or None if the setting is empty
+    """
+    if not settings.MIGRATION_JOB_STORE:
+        return None
+    return JobStore(settings.MIGRATION_JOB_STORE)
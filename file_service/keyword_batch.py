@@ -0,0 +1,86 @@
+"""
+Helpers shared by the commands that export a batch of iSites keywords: reading the keywords of a --csv file, running
+the exports on a pool of worker threads and recording which keywords failed.
+"""
+import csv
+import logging
+import threading
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import CommandError
+from django.db import connection as db_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_csv_keywords(csv_path):
+    """
+    Returns the keywords in the first column of the csv file at csv_path in order, without repeats
+    """
+    try:
+        with open(csv_path, 'rU') as csv_file:
+            keywords = [row[0] for row in csv.reader(csv_file)]
+    except (IOError, IndexError):
+        raise CommandError("Failed to read csv file %s" % csv_path)
+    return list(OrderedDict.fromkeys(keywords))
+
+
+def map_in_workers(func, items, workers, description):
+    """
+    Calls func with each of items, on up to workers threads if there is more than one item. Each worker thread closes
+    its database connection after every item.
+    """
+    if workers < 2 or len(items) < 2:
+        for item in items:
+            func(item)
+        return
+
+    logger.info("Exporting %s for %d keywords with %d workers", description, len(items), workers)
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        pool.map(partial(_call_in_worker, func), items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _call_in_worker(func, item):
+    try:
+        return func(item)
+    finally:
+        # Release this worker thread's Oracle connection between keywords
+        db_connection.close()
+
+
+class BatchResults(object):
+    """
+    Thread safe record of the keywords of a batch that failed or were skipped as unchanged
+    """
+
+    def __init__(self):
+        self.failures = []
+        self.skipped = []
+        self._lock = threading.Lock()
+
+    def record_failure(self, keyword):
+        with self._lock:
+            self.failures.append(keyword)
+
+    def record_skipped(self, keyword):
+        with self._lock:
+            self.skipped.append(keyword)
+
+    def log_summary(self, description, count):
+        logger.info(
+            "Completed %s of %d iSites keywords, %d successful %d unchanged %d failed.",
+            description,
+            count,
+            count - len(self.failures) - len(self.skipped),
+            len(self.skipped),
+            len(self.failures)
+        )
+        for keyword in sorted(self.failures):
+            logger.info("%s failed", keyword)
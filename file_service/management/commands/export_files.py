@@ -1,29 +1,41 @@
 import logging
 import os
-import shutil
-import csv
-import gzip
-import zipfile
+import resource
+import socket
+import threading
+import time
 import ssl
 if hasattr(ssl, '_create_unverified_context'):
     ssl._create_default_https_context = ssl._create_unverified_context
 
+from collections import Counter, OrderedDict
+from contextlib import closing
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection as db_connection
 from django.template.loader import get_template
 from django.template import Context
-from django.db.models import Q
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+from kitchen.text.converters import to_bytes
 
-from kitchen.text.converters import to_bytes, to_unicode
+from icommons_common.models import Site, CourseSite
 
-from icommons_common.models import Site, Topic, CourseSite
-
-from file_service.models import FileRepository, FileNode, FileNodeAttribute, ImageMetadata, TopicText
+from file_service.clients import get_bucket
+from file_service.compression import get_compress_type
+from file_service.content_cache import ContentCache
+from file_service.export_plan import KeywordExportPlan, KeywordSizeEstimate
+from file_service.job_store import EXPORTED, EXPORTING, FAILED, UNCHANGED, open_job_store
+from file_service.keyword_batch import BatchResults, map_in_workers, read_csv_keywords
+from file_service.manifest import ExportManifest
+from file_service.gzip_decode import GzipChunkReader, GzipDecodePool, GzipPrefetcher
+from file_service.s3_upload import MultipartUploadWriter, upload_file
+from file_service.storage_scheduler import StorageNodeReader, StorageNodeScheduler
+from file_service.work_queue import get_work_queue
+from file_service.zip_stream import ZIP_DEFLATED, ZipStreamWriter
 
 
 logger = logging.getLogger(__name__)
@@ -53,28 +65,181 @@ class Command(BaseCommand):
             default=None,
             help='Provide the path to a csv file containing iSites keyword/Canvas course ID pairs'
         ),
+        make_option(
+            '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=settings.EXPORT_FILES_WORKERS,
+            help='Number of keywords to export concurrently for the --term_id and --csv options'
+        ),
+        make_option(
+            '--stream',
+            action='store_true',
+            dest='stream',
+            default=False,
+            help='Stream each keyword archive straight to an S3 multipart upload instead of writing it to EXPORT_DIR'
+        ),
+        make_option(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Skip keywords whose files have not changed since the export recorded in their S3 manifest'
+        ),
+        make_option(
+            '--max_archive_bytes',
+            action='store',
+            type='int',
+            dest='max_archive_bytes',
+            default=settings.EXPORT_FILES_MAX_ARCHIVE_BYTES,
+            help='Split keywords whose files add up to more than this many bytes into several archives, 0 to disable'
+        ),
+        make_option(
+            '--plan',
+            action='store_true',
+            dest='plan',
+            default=False,
+            help='Write file counts and sizes for the keywords to the --plan_file instead of exporting them'
+        ),
+        make_option(
+            '--plan_file',
+            action='store',
+            dest='plan_file',
+            default=None,
+            help='Path of the plan file written by --plan. Batch exports given a plan file export the largest '
+                 'keywords first'
+        ),
+        make_option(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Skip keywords that an earlier run recorded as exported in the MIGRATION_JOB_STORE database'
+        ),
+        make_option(
+            '--enqueue',
+            action='store_true',
+            dest='enqueue',
+            default=False,
+            help='Add the keywords to the Redis work queue for --from_queue workers instead of exporting them'
+        ),
+        make_option(
+            '--from_queue',
+            action='store_true',
+            dest='from_queue',
+            default=False,
+            help='Claim keywords from the Redis work queue and export them with --workers threads until the queue is '
+                 'empty'
+        ),
+        make_option(
+            '--queue_name',
+            action='store',
+            dest='queue_name',
+            default=settings.WORK_QUEUE_NAME,
+            help='Name of the Redis work queue used by --enqueue and --from_queue'
+        ),
     )
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
-        self.connection = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_ACCESS_KEY)
-        self.bucket = self.connection.get_bucket(settings.AWS_EXPORT_BUCKET_SLIDE_TOOL, validate=False)
-        self.failures = []
+        self.workers = 1
+        self.stream = False
+        self.incremental = False
+        self.max_archive_bytes = 0
+        self.gzip_pool = None
+        self.deflate_pool = None
+        self.content_cache = None
+        self.io_scheduler = None
+        self.resume = False
+        self.job_store = None
+        self.work_queue = None
+        self.claimed = []
+        self.results = BatchResults()
+        # Called with each keyword that was exported or found unchanged, from the thread that exported it
+        self.exported_callback = None
+        # Once set, keywords that have not been started yet are not exported
+        self.stopped = threading.Event()
+        self._claimed_lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        # Each worker thread gets its own S3 connection, Django already keeps DB connections per thread
+        return get_bucket(settings.AWS_EXPORT_BUCKET_SLIDE_TOOL)
 
     def handle(self, *args, **options):
         term_id = options.get('term_id')
         csv_path = options.get('csv_path')
         keyword = options.get('keyword')
-        if term_id:
-            self._export_term(term_id)
+        self.workers = max(options.get('workers') or 1, 1)
+        self.stream = options.get('stream', False)
+        self.incremental = options.get('incremental', False)
+        self.max_archive_bytes = max(options.get('max_archive_bytes') or 0, 0)
+        plan_file = options.get('plan_file')
+        self.resume = options.get('resume', False)
+        from_queue = options.get('from_queue', False)
+        if not (term_id or csv_path or keyword or from_queue):
+            raise CommandError('You must provide one of the --term_id, --keyword, --csv, or --from_queue options.')
+        if self.resume and not settings.MIGRATION_JOB_STORE:
+            raise CommandError('--resume needs the MIGRATION_JOB_STORE setting.')
+
+        if from_queue:
+            keywords = []
+        elif term_id:
+            keywords = self._get_term_keywords(term_id)
         elif csv_path:
-            self._export_csv(csv_path)
-        elif keyword:
-            self._export_keyword(keyword)
+            keywords = read_csv_keywords(csv_path)
         else:
-            raise CommandError('You must provide one of the --term_id, --keyword, or --csv options.')
-
-    def _export_term(self, term_id):
+            keywords = [keyword]
+        # A keyword listed twice would be exported by two workers into the same archive and S3 key at once
+        keywords = list(OrderedDict.fromkeys(keywords))
+
+        if options.get('plan'):
+            self._write_plan(keywords, plan_file or os.path.join(settings.EXPORT_DIR, 'export_plan.csv'))
+            return
+        if plan_file:
+            keywords = self._schedule_keywords(keywords, plan_file)
+        if options.get('enqueue'):
+            get_work_queue(options.get('queue_name')).enqueue(keywords)
+            return
+
+        if settings.EXPORT_FILES_GZIP_PROCESSES:
+            self.gzip_pool = GzipDecodePool(
+                settings.EXPORT_FILES_GZIP_PROCESSES,
+                settings.EXPORT_FILES_READ_BUFFER_SIZE,
+                settings.EXPORT_DIR
+            )
+        if settings.EXPORT_FILES_DEFLATE_THREADS:
+            self.deflate_pool = ThreadPool(settings.EXPORT_FILES_DEFLATE_THREADS)
+        if settings.EXPORT_FILES_CONTENT_CACHE_BYTES:
+            self.content_cache = ContentCache(settings.EXPORT_DIR, settings.EXPORT_FILES_CONTENT_CACHE_BYTES)
+        self.io_scheduler = StorageNodeScheduler(
+            settings.EXPORT_FILES_STORAGE_NODE_CONCURRENCY,
+            settings.EXPORT_FILES_STORAGE_NODE_CONCURRENCY_LIMITS,
+            settings.EXPORT_FILES_STORAGE_NODE_STATS_INTERVAL
+        )
+        self.job_store = open_job_store()
+        try:
+            if from_queue:
+                keywords = self._export_from_queue(get_work_queue(options.get('queue_name')))
+            else:
+                self._export_keywords(keywords)
+        finally:
+            if self.job_store:
+                self.job_store.close()
+            if self.gzip_pool:
+                self.gzip_pool.close()
+            if self.deflate_pool:
+                self.deflate_pool.close()
+                self.deflate_pool.join()
+            if self.content_cache:
+                self.content_cache.log_stats()
+                self.content_cache.clear()
+            self.io_scheduler.log_stats()
+
+        self.results.log_summary('export', len(keywords))
+
+    def _get_term_keywords(self, term_id):
         keyword_sql_query = """
         SELECT cs.external_id AS external_id
         FROM course_instance ci, site_map sm, course_site cs
@@ -85,173 +250,531 @@ class Command(BaseCommand):
         sm.course_site_id = cs.course_site_id AND
         cs.site_type_id = 'isite';
         """
-        for cs in CourseSite.objects.raw(keyword_sql_query % term_id):
-            self._export_keyword(cs.external_id)
+        return [cs.external_id for cs in CourseSite.objects.raw(keyword_sql_query % term_id)]
 
-    def _export_csv(self, csv_path):
+    def _write_plan(self, keywords, plan_file):
+        estimates = KeywordSizeEstimate.estimate(keywords)
         try:
-            with open(csv_path, 'rU') as csv_file:
-                for row in csv.reader(csv_file):
-                    keyword = row[0]
-                    self._export_keyword(keyword)
-        except (IOError, IndexError):
-            raise CommandError("Failed to read csv file %s", csv_path)
-
-    def _export_keyword(self, keyword):
+            KeywordSizeEstimate.write_plan_file(plan_file, estimates)
+        except IOError:
+            raise CommandError("Failed to write plan file %s" % plan_file)
+
+        logger.info(
+            "Wrote export plan for %d iSites keywords to %s: %d topics, %d files, %d bytes (%d bytes on disk)",
+            len(estimates),
+            plan_file,
+            sum(e.topics for e in estimates),
+            sum(e.files for e in estimates),
+            sum(e.file_size for e in estimates),
+            sum(e.disk_size for e in estimates)
+        )
+        for estimate in estimates[:10]:
+            logger.info("%s: %d files, %d bytes", estimate.keyword, estimate.files, estimate.file_size)
+
+    def _schedule_keywords(self, keywords, plan_file):
+        """
+        Orders keywords largest first by the sizes in plan_file, so the biggest courses do not start last and stretch
+        the run, taking each storage node's keywords in turn so concurrent workers read from different nodes.
+        Keywords missing from the plan keep their order after the planned ones.
+        """
         try:
-            logger.info("Beginning iSites file export for keyword %s to S3 bucket %s", keyword, self.bucket.name)
-            try:
-                os.makedirs(os.path.join(settings.EXPORT_DIR, settings.CANVAS_IMPORT_FOLDER_PREFIX + keyword))
-            except os.error:
-                pass
+            estimates = KeywordSizeEstimate.read_plan_file(plan_file)
+        except (IOError, KeyError, ValueError):
+            raise CommandError("Failed to read plan file %s" % plan_file)
+
+        wanted = set(keywords)
+        planned = dict((e.keyword, e) for e in estimates if e.keyword in wanted)
+        planned_estimates = sorted(planned.values(), key=lambda e: e.file_size, reverse=True)
+        scheduled = [e.keyword for e in KeywordSizeEstimate.interleave_storage_nodes(planned_estimates)]
+        unplanned = [k for k in keywords if k not in planned]
+        logger.info(
+            "Scheduling %d keywords largest first by storage node from plan file %s, %d keywords are not in the plan",
+            len(scheduled),
+            plan_file,
+            len(unplanned)
+        )
+        return scheduled + unplanned
+
+    def _export_keywords(self, keywords):
+        map_in_workers(self._export_keyword, keywords, self.workers, 'files')
+
+    def _export_from_queue(self, work_queue):
+        """
+        Claims and exports keywords from work_queue on --workers threads until nothing is pending or leased on any
+        host, and returns the keywords claimed by this process
+        """
+        logger.info("Exporting keywords from work queue %s with %d workers", work_queue.name, self.workers)
+        self.work_queue = work_queue
+        pool = ThreadPool(self.workers)
+        try:
+            pool.map(self._work_queue_worker, range(self.workers), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        logger.info("Work queue %s: %s", work_queue.name, work_queue.get_stats())
+        return self.claimed
+
+    def _work_queue_worker(self, number):
+        worker_id = "%s:%d:%d" % (socket.gethostname(), os.getpid(), number)
+        try:
+            while not self.stopped.is_set():
+                keyword = self.work_queue.claim(worker_id)
+                if keyword is None:
+                    if self.work_queue.is_drained():
+                        return
+                    # Keywords leased by other workers come back if their leases expire
+                    time.sleep(settings.WORK_QUEUE_POLL_INTERVAL)
+                    continue
+
+                with self._claimed_lock:
+                    self.claimed.append(keyword)
+                with self.work_queue.heartbeat(keyword, worker_id) as heartbeat:
+                    exported = self._export_keyword(keyword, heartbeat)
+                if exported:
+                    self.work_queue.complete(keyword, worker_id)
+                else:
+                    self.work_queue.fail(keyword, worker_id, "Export failed on worker %s" % worker_id)
+        finally:
+            db_connection.close()
+
+    def _export_keyword(self, keyword, heartbeat=None):
+        """
+        Exports keyword, returning False if the export failed. Given the LeaseHeartbeat of a work queue claim, the
+        export is given up before anything is published once the lease has been lost.
+        """
+        if self.stopped.is_set():
+            logger.info("Not exporting keyword %s, the export has been stopped", keyword)
+            self.results.record_failure(keyword)
+            return False
 
+        max_rss = self._get_max_rss()
+        try:
+            if self.resume and self.job_store.get_export_state(keyword) in (EXPORTED, UNCHANGED):
+                logger.info("Skipping export for keyword %s, an earlier run already exported it", keyword)
+                self.results.record_skipped(keyword)
+                self._keyword_exported(keyword)
+                return True
+
+            self._set_export_state(keyword, EXPORTING)
+            logger.info("Beginning iSites file export for keyword %s to S3 bucket %s", keyword, self.bucket.name)
             try:
                 site = Site.objects.get(keyword=keyword)
             except Site.DoesNotExist:
                 raise CommandError('Could not find iSite for the keyword provided.')
 
-            self._export_readme(keyword)
+            plan = KeywordExportPlan.load(keyword, site)
+            manifest = ExportManifest.from_plan(plan)
+            previous = ExportManifest.load(self.bucket, keyword)
+            if self.incremental and self._is_unchanged(manifest, previous):
+                logger.info("Skipping export for keyword %s, no files have changed since the last export", keyword)
+                self.results.record_skipped(keyword)
+                self._set_export_state(keyword, UNCHANGED)
+                self._keyword_exported(keyword)
+                return True
+
+            for part in plan.split(self.max_archive_bytes):
+                if self.stream:
+                    self._stream_keyword(part, manifest, heartbeat)
+                else:
+                    self._upload_keyword_archive(part, manifest, heartbeat)
+            # Only written once the archive upload has completed, so an interrupted run is redone next time
+            self._check_lease(heartbeat)
+            manifest.save(self.bucket)
+            if previous is not None:
+                self._delete_stale_archives(manifest, previous)
 
-            query_set = Topic.objects.filter(site=site).exclude(
-                Q(tool_id__in=settings.EXPORT_FILES_EXCLUDED_TOOL_IDS) |
-                Q(title__in=settings.EXPORT_FILES_EXCLUDED_TOPIC_TITLES)
-            ).only(
-                'topic_id', 'title'
+            logger.info("Finished exporting files for keyword %s to S3 bucket %s", keyword, self.bucket.name)
+            self._set_export_state(keyword, EXPORTED)
+            self._keyword_exported(keyword)
+            return True
+        except Exception as e:
+            logger.exception("Failed to complete export for keyword %s", keyword)
+            self.results.record_failure(keyword)
+            self._set_export_state(keyword, FAILED, str(e))
+            return False
+        finally:
+            self.io_scheduler.log_stats_if_due()
+            peak_rss = self._get_max_rss()
+            # ru_maxrss is a process wide peak, with several workers it also covers the other keywords in flight
+            logger.info(
+                "Memory high-water mark after keyword %s: %d MB (%d MB higher than before it)",
+                keyword,
+                peak_rss // 1024,
+                (peak_rss - max_rss) // 1024
             )
-            logger.info('Attempting to export files for %d topics', query_set.count())
-            for topic in query_set:
-                if topic.title:
-                    topic_title = topic.title.strip().replace(' ', '_')
-                else:
-                    topic_title = 'no_title_%s' % topic.topic_id
-
-                file_repository_id = "icb.topic%s.files" % topic.topic_id
-                try:
-                    file_repository = FileRepository.objects.select_related('storage_node').only(
-                        'file_repository_id', 'storage_node'
-                    ).get(file_repository_id=file_repository_id)
-                    self._export_file_repository(file_repository, keyword, topic_title)
-                except FileRepository.DoesNotExist:
-                    logger.info("FileRepository does not exist for %s", file_repository_id)
-                    continue
 
-                self._export_topic_text(topic, keyword, topic_title)
+    def _check_lease(self, heartbeat):
+        if heartbeat is not None:
+            heartbeat.check()
 
-            zip_path_index = len(settings.EXPORT_DIR) + 1
-            keyword_export_path = os.path.join(settings.EXPORT_DIR, settings.CANVAS_IMPORT_FOLDER_PREFIX + keyword)
-            zip_filename = os.path.join(settings.EXPORT_DIR, "%s%s.zip" % (settings.CANVAS_IMPORT_FOLDER_PREFIX, keyword))
-            z_file = zipfile.ZipFile(zip_filename, 'w')
-            for root, dirs, files in os.walk(keyword_export_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    z_file.write(file_path, file_path[zip_path_index:])
-            z_file.close()
-            shutil.rmtree(keyword_export_path)
+    def _set_export_state(self, keyword, state, error=None):
+        if self.job_store is not None:
+            self.job_store.set_export_state(keyword, state, error)
 
-            export_key = Key(self.bucket)
-            export_key.key = "%s.zip" % keyword
-            export_key.set_metadata('Content-Type', 'application/zip')
-            export_key.set_contents_from_filename(zip_filename)
-            logger.info("Uploaded file export for keyword %s to S3 Key %s", keyword, export_key.key)
+    def _keyword_exported(self, keyword):
+        if self.exported_callback is not None:
+            self.exported_callback(keyword)
 
-            os.remove(zip_filename)
+    def _is_unchanged(self, manifest, previous):
+        if previous is None:
+            logger.info("No export manifest found for keyword %s", manifest.keyword)
+            return False
+        changes = manifest.changes_from(previous)
+        if changes:
+            logger.info("%d files changed for keyword %s since the last export", changes, manifest.keyword)
+        return not changes
 
-            logger.info("Finished exporting files for keyword %s to S3 bucket %s", keyword, self.bucket.name)
+    def _delete_stale_archives(self, manifest, previous):
+        """
+        Deletes archive parts left over from a previous export that was split differently
+        """
+        stale_keys = [key for key in previous.archive_keys if key not in manifest.archive_keys]
+        for key in stale_keys:
+            self.bucket.delete_key(key)
+            logger.info("Deleted stale archive %s for keyword %s", key, manifest.keyword)
+
+    def _upload_keyword_archive(self, part, manifest, heartbeat=None):
+        """
+        Builds an archive part in EXPORT_DIR straight from the storage nodes and uploads it to S3
+        """
+        keyword = part.plan.keyword
+        zip_filename = os.path.join(settings.EXPORT_DIR, settings.CANVAS_IMPORT_FOLDER_PREFIX + part.key_name)
+        try:
+            os.makedirs(settings.EXPORT_DIR)
+        except os.error:
+            pass
+
+        try:
+            with open(zip_filename, 'wb') as zip_file:
+                z_file = self._create_archive_writer(zip_file)
+                self._write_keyword_archive(part, z_file, manifest)
+                z_file.close()
+            self._log_compression(keyword, z_file)
+
+            self._check_lease(heartbeat)
+            checksums = z_file.archive_checksums
+            etag = upload_file(
+                self.bucket,
+                part.key_name,
+                zip_filename,
+                content_type='application/zip',
+                md5=checksums.get('md5')
+            )
+            manifest.add_archive_part(part.key_name, z_file.offset, len(z_file.entries), checksums, etag)
+            if self.job_store is not None:
+                self.job_store.record_archive(keyword, part.key_name, etag)
+            logger.info(
+                "Uploaded file export for keyword %s to S3 Key %s (%d entries, ETag %s)",
+                keyword,
+                part.key_name,
+                len(z_file.entries),
+                etag
+            )
+        finally:
+            try:
+                os.remove(zip_filename)
+            except os.error:
+                pass
+
+    def _stream_keyword(self, part, manifest, heartbeat=None):
+        """
+        Writes an archive part into an S3 multipart upload, without writing anything to EXPORT_DIR
+        """
+        keyword = part.plan.keyword
+        upload = MultipartUploadWriter(self.bucket, part.key_name, content_type='application/zip')
+        try:
+            z_file = self._create_archive_writer(upload)
+            self._write_keyword_archive(part, z_file, manifest)
+            z_file.close()
+            # The parts uploaded so far are cancelled if the lease was lost, the key is only written on completion
+            self._check_lease(heartbeat)
+            upload.close()
         except Exception:
-            logger.exception("Failed to complete export for keyword %s", keyword)
-            self.failures.append(keyword)
+            upload.abort()
+            raise
+        self._log_compression(keyword, z_file)
+        manifest.add_archive_part(
+            upload.key_name,
+            z_file.offset,
+            len(z_file.entries),
+            z_file.archive_checksums,
+            upload.etag
+        )
+        if self.job_store is not None:
+            self.job_store.record_archive(keyword, upload.key_name, upload.etag)
+
+        logger.info(
+            "Streamed file export for keyword %s to S3 Key %s (%d entries, %d bytes)",
+            keyword,
+            upload.key_name,
+            len(z_file.entries),
+            upload.bytes_written
+        )
 
-    def _export_file_repository(self, file_repository, keyword, topic_title):
-        logger.info("Exporting files for file_repository %s", file_repository.file_repository_id)
-        query_set = FileNode.objects.filter(
-            file_repository=file_repository,
-            file_type='file'
-        ).select_related('storage_node').only(
-            'file_node_id', 'file_type', 'storage_node', 'physical_location', 'file_path', 'file_name', 'encoding'
+    def _create_archive_writer(self, fileobj):
+        return ZipStreamWriter(
+            fileobj,
+            compress_level=settings.EXPORT_FILES_COMPRESS_LEVEL,
+            deflate_pool=self.deflate_pool,
+            deflate_window=settings.EXPORT_FILES_DEFLATE_THREADS,
+            checksums=settings.EXPORT_FILES_CHECKSUMS
+        )
+
+    def _log_compression(self, keyword, z_file):
+        deflated_entries = z_file.deflated_entries
+        file_size = sum(entry.file_size for entry in deflated_entries)
+        compress_size = sum(entry.compress_size for entry in deflated_entries)
+        logger.info(
+            "Deflated %d of %d archive entries for keyword %s, saving %d of %d bytes in %.2f seconds of deflate time",
+            len(deflated_entries),
+            len(z_file.entries),
+            keyword,
+            file_size - compress_size,
+            file_size,
+            z_file.compress_time
         )
-        for file_node in query_set:
-            if file_node.storage_node:
-                storage_node_location = file_node.storage_node.physical_location
-            elif file_repository.storage_node:
-                storage_node_location = file_repository.storage_node.physical_location
-            else:
-                logger.error("Failed to find storage node for file node %d", file_node.file_node_id)
-                continue
 
-            physical_location = file_node.physical_location.lstrip('/')
-            if not physical_location:
-                # Assume non fs-cow file and use file_path and file_name to construct physical location
-                physical_location = os.path.join(
-                    file_node.file_path.lstrip('/'),
-                    file_node.file_name.lstrip('/')
+    def _write_keyword_archive(self, part, z_file, manifest):
+        """
+        Writes the topic files and topic text of an archive part into z_file, and the README if it is the first part.
+        Each source under the storage node is opened once and copied straight into its archive entry. The checksums of
+        each entry are recorded in manifest.
+        """
+        plan = part.plan
+        source_files = self._get_source_files(part)
+        shared_source_files = set(
+            source_file for source_file, count in Counter(source_files.values()).items() if count > 1
+        )
+        if part.includes_readme:
+            z_file.write_str(plan.readme_arcname, to_bytes(self._render_readme()), compress_type=ZIP_DEFLATED)
+        gzip_prefetcher = self._start_gzip_prefetch(part, source_files)
+        try:
+            for topic_export in part.topic_exports:
+                self._write_file_repository(
+                    z_file,
+                    topic_export,
+                    manifest,
+                    source_files,
+                    shared_source_files,
+                    gzip_prefetcher
                 )
+                self._write_topic_text(z_file, topic_export, manifest)
+        finally:
+            if gzip_prefetcher:
+                gzip_prefetcher.close()
+
+        reused = len([entry for entry in z_file.entries if entry.reused])
+        if reused:
+            logger.info(
+                "Copied %d of %d files for %s from the content cache",
+                reused,
+                len(source_files),
+                part.key_name
+            )
 
-            source_file = os.path.join(storage_node_location, physical_location)
-            export_file = to_bytes(os.path.join(
-                settings.EXPORT_DIR,
-                settings.CANVAS_IMPORT_FOLDER_PREFIX + keyword,
-                to_unicode(topic_title),
-                to_unicode(file_node.file_path.lstrip('/')),
-                to_unicode(file_node.file_name.lstrip('/'))
-            ))
-            try:
-                os.makedirs(os.path.dirname(export_file))
-            except os.error:
-                pass
+    def _get_source_files(self, part):
+        """
+        Returns an ordered mapping of file_node_id to the source file under its storage node
+        """
+        source_files = OrderedDict()
+        for topic_export in part.topic_exports:
+            for file_node in topic_export.file_nodes:
+                source_file = self._get_source_file(file_node, topic_export.file_repository)
+                if source_file is not None:
+                    source_files[file_node.file_node_id] = source_file
+        return source_files
+
+    def _start_gzip_prefetch(self, part, source_files):
+        """
+        Starts decoding the archive part's large gzip file nodes in the gzip process pool, in archive order
+        """
+        if self.gzip_pool is None:
+            return None
+
+        sources = []
+        prefetched = set()
+        for topic_export in part.topic_exports:
+            for file_node in topic_export.file_nodes:
+                if file_node.encoding != 'gzip' or file_node.file_size < settings.EXPORT_FILES_GZIP_PROCESS_MIN_SIZE:
+                    continue
+                source_file = source_files.get(file_node.file_node_id)
+                if source_file is None:
+                    continue
+                if self.content_cache and source_file in prefetched:
+                    # Later references to a shared blob are served from the content cache
+                    continue
+                prefetched.add(source_file)
+                sources.append((
+                    file_node.file_node_id,
+                    self._get_storage_node_location(file_node, topic_export.file_repository),
+                    source_file
+                ))
+        if not sources:
+            return None
+
+        logger.info("Decoding %d large gzip files for %s in worker processes", len(sources), part.key_name)
+        return GzipPrefetcher(
+            self.gzip_pool,
+            sources,
+            settings.EXPORT_FILES_GZIP_PROCESSES * 2,
+            scheduler=self.io_scheduler
+        )
+
+    def _get_storage_node_location(self, file_node, file_repository):
+        if file_node.storage_node:
+            return file_node.storage_node.physical_location
+        elif file_repository.storage_node:
+            return file_repository.storage_node.physical_location
+        return None
+
+    def _get_source_file(self, file_node, file_repository):
+        storage_node_location = self._get_storage_node_location(file_node, file_repository)
+        if storage_node_location is None:
+            logger.error("Failed to find storage node for file node %d", file_node.file_node_id)
+            return None
+
+        physical_location = file_node.physical_location.lstrip('/')
+        if not physical_location:
+            # Assume non fs-cow file and use file_path and file_name to construct physical location
+            physical_location = os.path.join(
+                file_node.file_path.lstrip('/'),
+                file_node.file_name.lstrip('/')
+            )
+
+        return os.path.join(storage_node_location, physical_location)
 
+    def _open_source_file(self, file_node, source_file, storage_node_location, gzip_prefetcher=None):
+        """
+        Returns a file object for the decoded source of file_node. Sources up to EXPORT_FILES_SOURCE_BUFFER_SIZE are
+        read whole into memory, so their storage node read slot is free again before they are compressed and uploaded.
+        Bigger sources are streamed and give back their slot once read to the end or closed.
+        """
+        if file_node.encoding == 'gzip' and gzip_prefetcher:
+            decoded_file = gzip_prefetcher.open(file_node.file_node_id)
+            if decoded_file is not None:
+                return decoded_file
+
+        slot = self.io_scheduler.acquire(storage_node_location)
+        try:
             if file_node.encoding == 'gzip':
-                try:
-                    with gzip.open(source_file, 'rb') as s_file:
-                        with open(export_file, 'w') as d_file:
-                            for line in s_file:
-                                d_file.write(to_bytes(line, 'utf8'))
-                except IOError:
-                    logger.exception(
-                        "Failed to export file node %s from file repository % in keyword %s",
-                        file_node.file_node_id,
-                        file_repository.file_repository_id,
-                        keyword
-                    )
-                    continue
+                s_file = GzipChunkReader(source_file, settings.EXPORT_FILES_READ_BUFFER_SIZE)
             else:
-                try:
-                    shutil.copy(source_file, export_file)
-                except IOError:
-                    logger.exception("Could not find source file %s", source_file)
+                s_file = open(source_file, 'rb')
+        except Exception:
+            slot.release()
+            raise
+
+        s_file = StorageNodeReader(s_file, slot)
+        if file_node.file_size is None or file_node.file_size > settings.EXPORT_FILES_SOURCE_BUFFER_SIZE:
+            return s_file
+        with closing(s_file):
+            return BytesIO(s_file.read())
+
+    def _write_file_repository(self, z_file, topic_export, manifest, source_files, shared_source_files,
+                               gzip_prefetcher=None):
+        file_repository = topic_export.file_repository
+        logger.info("Exporting files for file_repository %s", file_repository.file_repository_id)
+        for file_node in topic_export.file_nodes:
+            source_file = source_files.get(file_node.file_node_id)
+            if source_file is None:
+                continue
+
+            arcname = topic_export.get_file_node_arcname(file_node)
+            compress_type = get_compress_type(file_node.file_name, file_node.content_type)
+            cached, cache_fill = None, None
+            if self.content_cache is not None:
+                cached, cache_fill = self.content_cache.get(
+                    (source_file, compress_type),
+                    shared=source_file in shared_source_files
+                )
+
+            if cached is not None:
+                entry = self._write_cached_file_node(z_file, file_node, cached, arcname, gzip_prefetcher)
+                if entry is not None:
+                    manifest.record_file_node(file_node.file_node_id, entry.checksums)
+                    logger.info("Copied cached file %s to archive entry %s", source_file, arcname)
                     continue
 
-            logger.info("Copied file %s to export location %s", source_file, export_file)
-
-    def _export_topic_text(self, topic, keyword, topic_title):
-        logger.info("Exporting text for topic %d %s", topic.topic_id, topic_title)
-        for topic_text in TopicText.objects.filter(topic_id=topic.topic_id).only('text_id', 'name', 'source_text'):
-            export_file = to_bytes(os.path.join(
-                settings.EXPORT_DIR,
-                settings.CANVAS_IMPORT_FOLDER_PREFIX + keyword,
-                to_unicode(topic_title),
-                to_unicode(topic_text.name.lstrip('/'))
-            ))
+            storage_node_location = self._get_storage_node_location(file_node, file_repository)
             try:
-                os.makedirs(os.path.dirname(export_file))
-            except os.error:
-                pass
+                s_file = self._open_source_file(file_node, source_file, storage_node_location, gzip_prefetcher)
+            except IOError:
+                logger.exception("Could not read source file %s", source_file)
+                # Recorded so the next --incremental run sees a change and rebuilds the archive with the file
+                manifest.record_unreadable_file_node(file_node.file_node_id)
+                if cache_fill:
+                    cache_fill.abort()
+                continue
+            except Exception:
+                if cache_fill:
+                    cache_fill.abort()
+                raise
 
-            with open(export_file, 'w') as f:
-                f.write(to_bytes(topic_text.source_text, 'utf8'))
+            try:
+                entry = z_file.write_fileobj(
+                    arcname,
+                    s_file,
+                    compress_type=compress_type,
+                    size_hint=file_node.file_size,
+                    chunk_size=settings.EXPORT_FILES_READ_BUFFER_SIZE,
+                    payload_sink=cache_fill
+                )
+            except Exception:
+                if cache_fill:
+                    cache_fill.abort()
+                raise
+            finally:
+                s_file.close()
+            if cache_fill:
+                cache_fill.commit(entry)
+            manifest.record_file_node(file_node.file_node_id, entry.checksums)
+
+            logger.info("Copied file %s to archive entry %s", source_file, arcname)
+
+    def _write_cached_file_node(self, z_file, file_node, cached, arcname, gzip_prefetcher=None):
+        """
+        Writes a file node whose blob is in the content cache, returning None if the cached payload has since been
+        evicted
+        """
+        try:
+            payload = cached.open()
+        except IOError:
+            return None
+        if gzip_prefetcher:
+            gzip_prefetcher.discard(file_node.file_node_id)
+        try:
+            return z_file.write_payload(
+                arcname,
+                payload,
+                cached.crc,
+                cached.file_size,
+                cached.compress_size,
+                cached.compress_type,
+                chunk_size=settings.EXPORT_FILES_READ_BUFFER_SIZE,
+                checksums=cached.checksums
+            )
+        finally:
+            payload.close()
+
+    def _write_topic_text(self, z_file, topic_export, manifest):
+        logger.info("Exporting text for topic %d %s", topic_export.topic.topic_id, topic_export.title)
+        for topic_text, source_text in topic_export.iter_topic_texts():
+            arcname = topic_export.get_topic_text_arcname(topic_text)
+            entry = z_file.write_str(
+                arcname,
+                to_bytes(source_text, 'utf8'),
+                compress_type=get_compress_type(topic_text.name)
+            )
+            manifest.record_topic_text(topic_text.text_id, entry.checksums)
 
-            logger.info("Copied TopicText %d to export location %s", topic_text.text_id, export_file)
+            logger.info("Copied TopicText %d to archive entry %s", topic_text.text_id, arcname)
 
-    def _export_readme(self, keyword):
+    def _render_readme(self):
         readme_template = get_template('file_service/export_files_readme.html')
-        content = readme_template.render(Context({}))
-        readme_file = os.path.join(
-            settings.EXPORT_DIR,
-            settings.CANVAS_IMPORT_FOLDER_PREFIX + keyword,
-            settings.EXPORT_FILES_README_FILENAME
-        )
-        try:
-            os.makedirs(os.path.dirname(readme_file))
-        except os.error:
-            pass
-        with open(readme_file, 'w') as f:
-            f.write(content)
+        return readme_template.render(Context({}))
+
+    def _get_max_rss(self):
+        """
+        Returns the peak resident set size of the process in KB
+        """
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -1,8 +1,13 @@
+import gzip
+import hashlib
 import logging
 import os
 import mimetypes
 import json
 import ssl
+from collections import defaultdict, OrderedDict
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 if hasattr(ssl, '_create_unverified_context'):
     ssl._create_default_https_context = ssl._create_unverified_context
 
@@ -10,17 +15,51 @@ from optparse import make_option
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
 
-from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from boto.utils import parse_ts
 
 from icommons_common.models import Site, Topic
 
 from file_service.models import FileRepository, FileNode, FileNodeAttribute, ImageMetadata
+from file_service.clients import get_bucket
+from file_service.export_plan import MAX_IN_LIST_SIZE
+from file_service.keyword_batch import BatchResults, map_in_workers, read_csv_keywords
+from file_service.s3_upload import upload_file
 
 
 logger = logging.getLogger(__name__)
 
+SLIDE_INDEX_VERSION = 1
+
+SLIDE_TOPICS_SQL = """
+SELECT t.topic_id AS topic_id, t.title AS title, s.keyword AS keyword, s.name AS site_name
+FROM topic t, page_content pc, page p, site s
+WHERE
+%s AND
+p.site_id = s.site_id AND
+pc.page_id = p.page_id AND
+t.topic_id = pc.topic_id AND
+t.tool_id = %%s
+"""
+
+TERM_SLIDE_TOPICS_SQL = """
+SELECT t.topic_id AS topic_id, t.title AS title, s.keyword AS keyword, s.name AS site_name
+FROM course_instance ci, site_map sm, course_site cs, site s, page p, page_content pc, topic t
+WHERE
+ci.term_id = %s AND
+sm.course_instance_id = ci.course_instance_id AND
+sm.map_type_id = 'official' AND
+sm.course_site_id = cs.course_site_id AND
+cs.site_type_id = 'isite' AND
+s.keyword = cs.external_id AND
+p.site_id = s.site_id AND
+pc.page_id = p.page_id AND
+t.topic_id = pc.topic_id AND
+t.tool_id = %s
+"""
+
 
 class Command(BaseCommand):
     help = 'Exports iSites Slide Tool topic file repositories to AWS S3'
@@ -32,55 +71,158 @@ class Command(BaseCommand):
             default=None,
             help='Provide an iSite keyword'
         ),
+        make_option(
+            '--term_id',
+            action='store',
+            dest='term_id',
+            default=None,
+            help='Provide an SIS term ID'
+        ),
+        make_option(
+            '--csv',
+            action='store',
+            dest='csv_path',
+            default=None,
+            help='Provide the path to a csv file containing iSites keywords'
+        ),
+        make_option(
+            '--sync',
+            action='store_true',
+            dest='sync',
+            default=False,
+            help='Only upload images that are new or have changed since they were last exported'
+        ),
+        make_option(
+            '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=settings.EXPORT_SLIDE_TOOL_WORKERS,
+            help='Number of keywords to export concurrently for the --term_id and --csv options'
+        ),
+        make_option(
+            '--upload_threads',
+            action='store',
+            type='int',
+            dest='upload_threads',
+            default=settings.EXPORT_SLIDE_TOOL_UPLOAD_THREADS,
+            help='Number of images to upload concurrently for each keyword'
+        ),
     )
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
-        self.connection = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_ACCESS_KEY)
-        self.bucket = self.connection.get_bucket(settings.AWS_EXPORT_BUCKET_SLIDE_TOOL, validate=False)
+        self.sync = False
+        self.workers = 1
+        self.upload_threads = 1
+        self.results = BatchResults()
+
+    @property
+    def bucket(self):
+        return get_bucket(settings.AWS_EXPORT_BUCKET_SLIDE_TOOL)
 
     def handle(self, *args, **options):
         keyword = options['keyword']
-        if not keyword:
-            # Prompt for iSite keyword
-            keyword = raw_input('iSite Keyword: ')
+        term_id = options.get('term_id')
+        csv_path = options.get('csv_path')
+        self.sync = options.get('sync', False)
+        self.workers = max(options.get('workers') or 1, 1)
+        self.upload_threads = max(options.get('upload_threads') or 1, 1)
+
+        if term_id:
+            keyword_topics = self._get_term_topics(term_id)
+        elif csv_path:
+            keyword_topics = self._get_keyword_topics(read_csv_keywords(csv_path))
+        else:
             if not keyword:
-                raise CommandError('You must provide an iSite keyword.')
+                # Prompt for iSite keyword
+                keyword = raw_input('iSite Keyword: ')
+                if not keyword:
+                    raise CommandError('You must provide an iSite keyword.')
+            if not Site.objects.filter(keyword=keyword).exists():
+                raise CommandError('Could not find iSite for the keyword provided.')
+            keyword_topics = self._get_keyword_topics([keyword])
+            if not keyword_topics:
+                logger.info("No slide tool topics found for keyword %s", keyword)
+                return
+            site_name, topics = keyword_topics[keyword]
+            self._export_keyword(keyword, site_name, topics)
+            return
 
-        logger.info("Beginning export_slide_tool for keyword %s to S3 bucket %s", keyword, self.bucket.name)
+        map_in_workers(self._export_keyword_in_worker, list(keyword_topics.items()), self.workers, 'slide tool data')
+        self.results.log_summary('slide tool export', len(keyword_topics))
+
+    def _get_keyword_topics(self, keywords):
+        """
+        Returns an ordered mapping of keyword to (site name, slide tool topics) for every keyword with slide tool
+        topics, with one query per 1000 keywords
+        """
+        keyword_topics = OrderedDict()
+        for i in range(0, len(keywords), MAX_IN_LIST_SIZE):
+            chunk = keywords[i:i + MAX_IN_LIST_SIZE]
+            keyword_filter = "s.keyword IN (%s)" % ', '.join(['%s'] * len(chunk))
+            self._group_topics(
+                keyword_topics,
+                Topic.objects.raw(SLIDE_TOPICS_SQL % keyword_filter, list(chunk) + [settings.SLIDE_TOOL_ID])
+            )
+        return keyword_topics
+
+    def _get_term_topics(self, term_id):
+        """
+        Returns an ordered mapping of keyword to (site name, slide tool topics) for the official iSites of a term, in
+        a single query
+        """
+        keyword_topics = OrderedDict()
+        self._group_topics(keyword_topics, Topic.objects.raw(TERM_SLIDE_TOPICS_SQL, [term_id, settings.SLIDE_TOOL_ID]))
+        return keyword_topics
+
+    def _group_topics(self, keyword_topics, topics):
+        seen = set()
+        for topic in topics:
+            # A topic placed on several pages is only exported once
+            if topic.topic_id in seen:
+                continue
+            seen.add(topic.topic_id)
+            keyword_topics.setdefault(topic.keyword, (topic.site_name, []))[1].append(topic)
+
+    def _export_keyword_in_worker(self, item):
+        keyword, (site_name, topics) = item
         try:
-            site = Site.objects.get(keyword=keyword)
-        except Site.DoesNotExist:
-            raise CommandError('Could not find iSite for the keyword provided.')
-
-        topic_sql_query = """
-        SELECT t.topic_id AS topic_id, t.title AS title
-        FROM topic t, page_content pc, page p, site s
-        WHERE
-        s.keyword = '%s' AND
-        p.site_id = s.site_id AND
-        pc.page_id = p.page_id AND
-        t.topic_id = pc.topic_id AND
-        t.tool_id = %s
-        """
-        topics = Topic.objects.raw(topic_sql_query % (keyword, settings.SLIDE_TOOL_ID))
+            self._export_keyword(keyword, site_name, topics)
+        except Exception:
+            logger.exception("Failed to complete slide tool export for keyword %s", keyword)
+            self.results.record_failure(keyword)
+
+    def _export_keyword(self, keyword, site_name, topics):
+        logger.info("Beginning export_slide_tool for keyword %s to S3 bucket %s", keyword, self.bucket.name)
+        existing_keys = {}
+        if self.sync:
+            existing_keys = self._get_existing_keys(keyword)
+
+        uploads = []
+        unchanged = 0
+        topic_datas = []
         for topic in topics:
             logger.info("Exporting files for topic %d %s", topic.topic_id, topic.title)
             topic_data = {
                 'keyword': keyword,
-                'site_title': site.name,
+                'site_title': site_name,
                 'topic_id': topic.topic_id,
                 'topic_title': topic.title,
                 'files': []
             }
             file_repository_id = "icb.topic%s.files" % topic.topic_id
             try:
-                file_repository = FileRepository.objects.get(file_repository_id=file_repository_id)
+                file_repository = FileRepository.objects.select_related('storage_node').get(
+                    file_repository_id=file_repository_id
+                )
             except FileRepository.DoesNotExist:
                 logger.error("FileRepository does not exist for %s", file_repository_id)
                 continue
 
-            for file_node in FileNode.objects.filter(file_repository=file_repository):
+            image_metadata = self._get_image_metadata(file_repository)
+            link_urls = self._get_link_urls(file_repository)
+            for file_node in FileNode.objects.filter(file_repository=file_repository).select_related('storage_node'):
                 if file_node.file_type == 'file':
                     if file_node.storage_node:
                         storage_node_location = file_node.storage_node.physical_location
@@ -91,20 +233,17 @@ class Command(BaseCommand):
                         continue
 
                     file_name = os.path.basename(file_node.physical_location)
-                    file_key = Key(self.bucket)
-                    file_key.key = "%s/%d/%s" % (keyword, topic.topic_id, file_name)
-
-                    content_type, _ = mimetypes.guess_type(file_name)
-                    if content_type is not None:
-                        file_key.set_metadata('Content-Type', content_type)
-                    file_key.set_contents_from_filename(storage_node_location + file_node.physical_location)
-                    logger.info("Uploaded image to S3 Key %s", file_key.key)
+                    key_name = "%s/%d/%s" % (keyword, topic.topic_id, file_name)
+                    if self._is_unchanged(existing_keys.get(key_name), file_node):
+                        unchanged += 1
+                    else:
+                        content_type, _ = mimetypes.guess_type(file_name)
+                        uploads.append((key_name, storage_node_location + file_node.physical_location, content_type))
 
-                    url = file_key.key
+                    url = key_name
                 elif file_node.file_type == 'link':
-                    try:
-                        url = FileNodeAttribute.objects.get(file_node_id=file_node.file_node_id, attribute='url').value
-                    except FileNodeAttribute.DoesNotExist:
+                    url = link_urls.get(file_node.file_node_id)
+                    if url is None:
                         logger.error(
                             "Failed to find URL for file node link %s %s %d",
                             keyword,
@@ -122,17 +261,150 @@ class Command(BaseCommand):
                     'url': url
                 }
 
-                for im in ImageMetadata.objects.filter(file_node=file_node):
-                    field_name = im.topic_metadata_set.metadata_cv.label
-                    field_value = im.metadata_data
+                for field_name, field_value in image_metadata[file_node.file_node_id]:
                     file_data[field_name] = field_value
 
                 topic_data['files'].append(file_data)
 
-            data_key = Key(self.bucket)
-            data_key.key = "%s/%d/data.json" % (keyword, topic.topic_id)
-            data_key.set_metadata('Content-Type', 'application/json')
-            data_key.set_contents_from_string(json.dumps(topic_data))
-            logger.info("Uploaded file repository data to S3 Key %s", data_key.key)
+            topic_datas.append(topic_data)
+
+        self._upload_images(uploads)
+        payloads = [self._upload_topic_data(data, existing_keys) for data in topic_datas]
+        self._upload_slide_index(keyword, site_name, topic_datas, payloads, existing_keys)
+
+        logger.info(
+            "Finished export_slide_tool for keyword %s to S3 bucket %s: %d images uploaded, %d unchanged",
+            keyword,
+            self.bucket.name,
+            len(uploads),
+            unchanged
+        )
+
+    def _get_existing_keys(self, keyword):
+        """
+        Lists the keys already exported for keyword in one paginated pass
+        """
+        existing_keys = dict((key.name, key) for key in self.bucket.list(prefix="%s/" % keyword))
+        logger.info("Found %d existing S3 Keys for keyword %s", len(existing_keys), keyword)
+        return existing_keys
+
+    def _is_unchanged(self, key, file_node):
+        """
+        An image is unchanged if its S3 Key has the FileNode's size and was uploaded after the FileNode last changed
+        """
+        if key is None:
+            return False
+        uploaded = timezone.make_aware(parse_ts(key.last_modified), timezone.utc)
+        return key.size == file_node.file_size and uploaded >= file_node.last_modified
+
+    def _upload_images(self, uploads):
+        if self.upload_threads < 2 or len(uploads) < 2:
+            for upload in uploads:
+                self._upload_image(upload)
+            return
+
+        pool = ThreadPool(min(self.upload_threads, len(uploads)))
+        try:
+            pool.map(self._upload_image, uploads, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _upload_image(self, upload):
+        key_name, file_name, content_type = upload
+        upload_file(self.bucket, key_name, file_name, content_type=content_type)
+        logger.info("Uploaded image to S3 Key %s", key_name)
+
+    def _upload_topic_data(self, topic_data, existing_keys):
+        """
+        Uploads a topic's data.json unless S3 already has the same content, and returns the JSON
+        """
+        data = json.dumps(topic_data)
+        key_name = "%s/%d/data.json" % (topic_data['keyword'], topic_data['topic_id'])
+        existing_key = existing_keys.get(key_name)
+        if existing_key is not None and existing_key.etag.strip('"') == hashlib.md5(data).hexdigest():
+            logger.info("File repository data in S3 Key %s is unchanged", key_name)
+            return data
+
+        data_key = Key(self.bucket)
+        data_key.key = key_name
+        data_key.set_metadata('Content-Type', 'application/json')
+        data_key.set_contents_from_string(data)
+        logger.info("Uploaded file repository data to S3 Key %s", data_key.key)
+        return data
+
+    def _upload_slide_index(self, keyword, site_name, topic_datas, payloads, existing_keys):
+        """
+        Uploads <keyword>/index.json, which holds every topic's data.json so a viewer can render all of a site's slide
+        tools from one object. The data.json payloads are concatenated in its data field. Each topic lists the key,
+        ETag, offset and length of its payload, so a consumer that has cached an earlier index only needs to re-read
+        the topics whose ETag changed. The index is stored gzip encoded.
+        """
+        topics = []
+        offset = 0
+        for topic_data, data in zip(topic_datas, payloads):
+            topics.append({
+                'topic_id': topic_data['topic_id'],
+                'topic_title': topic_data['topic_title'],
+                'key': "%s/%d/data.json" % (keyword, topic_data['topic_id']),
+                'etag': hashlib.md5(data).hexdigest(),
+                'offset': offset,
+                'length': len(data),
+            })
+            offset += len(data)
+        index = json.dumps({
+            'version': SLIDE_INDEX_VERSION,
+            'keyword': keyword,
+            'site_title': site_name,
+            'topics': topics,
+            'data': ''.join(payloads),
+        })
+
+        buf = BytesIO()
+        # A fixed mtime keeps the gzip output, and so the ETag, the same for the same index
+        with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as gzip_file:
+            gzip_file.write(index)
+        body = buf.getvalue()
+
+        key_name = "%s/index.json" % keyword
+        existing_key = existing_keys.get(key_name)
+        if existing_key is not None and existing_key.etag.strip('"') == hashlib.md5(body).hexdigest():
+            logger.info("Slide index in S3 Key %s is unchanged", key_name)
+            return
+
+        index_key = Key(self.bucket)
+        index_key.key = key_name
+        index_key.set_metadata('Content-Type', 'application/json')
+        index_key.set_metadata('Content-Encoding', 'gzip')
+        index_key.set_contents_from_string(body)
+        logger.info(
+            "Uploaded slide index for %d topics to S3 Key %s (%d bytes, %d gzipped)",
+            len(topics),
+            key_name,
+            len(index),
+            len(body)
+        )
+
+    def _get_image_metadata(self, file_repository):
+        """
+        Returns the (metadata CV label, value) pairs of every file node in file_repository, keyed by file_node_id,
+        from a single joined query
+        """
+        image_metadata = defaultdict(list)
+        for file_node_id, label, metadata_data in ImageMetadata.objects.filter(
+            file_node__file_repository=file_repository
+        ).values_list('file_node', 'topic_metadata_set__metadata_cv__label', 'metadata_data'):
+            image_metadata[file_node_id].append((label, metadata_data))
+        return image_metadata
 
-        logger.info("Finished export_slide_tool for keyword %s to S3 bucket %s", keyword, self.bucket.name)
+    def _get_link_urls(self, file_repository):
+        """
+        Returns the URL attribute of every link in file_repository, keyed by file_node_id, from a single query
+        """
+        return dict(FileNodeAttribute.objects.filter(
+            attribute='url',
+            file_node_id__in=FileNode.objects.filter(
+                file_repository=file_repository,
+                file_type='link'
+            ).values('file_node_id')
+        ).values_list('file_node_id', 'value'))
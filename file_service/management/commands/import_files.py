@@ -1,8 +1,10 @@
 import logging
 import csv
 import json
-import time
 import ssl
+import time
+from collections import deque
+from Queue import Empty
 if hasattr(ssl, '_create_unverified_context'):
     ssl._create_default_https_context = ssl._create_unverified_context
 
@@ -11,16 +13,22 @@ from optparse import make_option
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from boto.s3.connection import S3Connection
-
 from canvas_sdk.methods import content_migrations, files
 from canvas_sdk.exceptions import CanvasAPIError
 
-from icommons_common.canvas_utils import SessionInactivityExpirationRC
+from boto.s3.key import Key
+
+from file_service.canvas_admission import CanvasAdmission, is_rate_limited
+from file_service.clients import get_bucket, get_canvas_context
+from file_service.job_store import COMPLETED, FAILED, IMPORTING, RUNNING, open_job_store
+from file_service.manifest import ExportManifest
+from file_service.progress_poller import ProgressPoller
 
 
 logger = logging.getLogger(__name__)
-SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
+
+# Canvas caps per_page at 100
+FOLDER_LIST_PER_PAGE = 100
 
 
 class Command(BaseCommand):
@@ -47,61 +55,154 @@ class Command(BaseCommand):
             default=None,
             help='Provide the path to a csv file containing iSites keyword/Canvas course ID pairs'
         ),
+        make_option(
+            '--max_in_flight',
+            action='store',
+            type='int',
+            dest='max_in_flight',
+            default=None,
+            help='Maximum number of Canvas content migrations running at once, defaults to CANVAS_IMPORT_MAX_IN_FLIGHT'
+        ),
+        make_option(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Skip imports that an earlier run recorded as complete in the MIGRATION_JOB_STORE database and resume '
+                 'polling the content migrations it left running'
+        ),
     )
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
-        self.connection = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_ACCESS_KEY)
-        self.bucket = self.connection.get_bucket(settings.AWS_EXPORT_BUCKET_SLIDE_TOOL, validate=False)
+        # Progress URLs of the content migrations in flight, keyed by (keyword, canvas_course_id, key_name)
         self.canvas_progress_urls = {}
+        # Export archives waiting to be submitted to Canvas, as (keyword, key_name, canvas_course_id)
+        self.pending_imports = deque()
+        # Content migrations started by an earlier run, as (keyword, key_name, canvas_course_id, progress_url)
+        self.resumed_imports = []
+        self.completed_imports = set()
+        self.failed_imports = set()
+        self.imports = set()
+        self.admission = None
+        self.resume = False
+        self.job_store = None
+        # Per run caches, so each course's root folder and import folder is only looked up once
+        self._root_folders = {}
+        self._import_folders = {}
+
+    @property
+    def bucket(self):
+        return get_bucket(settings.AWS_EXPORT_BUCKET_SLIDE_TOOL)
 
     def handle(self, *args, **options):
         keyword = options.get('keyword')
         canvas_course_id = options.get('canvas_course_id')
         csv_path = options.get('csv_path')
-
-        if csv_path:
-            self._import_csv(csv_path)
-        elif keyword and canvas_course_id:
-            self._import_isite(keyword, canvas_course_id)
-        else:
+        self.resume = options.get('resume', False)
+        if not (csv_path or (keyword and canvas_course_id)):
             raise CommandError(
                 'You must provide either the --keyword and --canvas_course_id options or the --csv option.'
             )
+        if self.resume and not settings.MIGRATION_JOB_STORE:
+            raise CommandError('--resume needs the MIGRATION_JOB_STORE setting.')
 
-        import_count = len(self.canvas_progress_urls)
-        completed = set()
-        failed = set()
-        while self.canvas_progress_urls:
-            time.sleep(2)
-            completed_imports = []
-            failed_imports = []
-            for keyword, (canvas_course_id, progress_url) in self.canvas_progress_urls.iteritems():
-                progress = json.loads(SDK_CONTEXT.session.request('GET', progress_url).text)
-                workflow_state = progress['workflow_state']
-                if workflow_state == 'completed':
-                    self._lock_canvas_folder(canvas_course_id, settings.CANVAS_IMPORT_FOLDER_PREFIX + keyword)
-                    completed_imports.append((keyword, canvas_course_id))
-                elif workflow_state == 'failed':
-                    failed_imports.append((keyword, canvas_course_id))
-
-            for (keyword, canvas_course_id) in completed_imports + failed_imports:
-                self.canvas_progress_urls.pop(keyword, None)
-
-            completed.update(completed_imports)
-            failed.update(failed_imports)
-            count_processing = len(self.canvas_progress_urls)
-            if count_processing:
-                logger.info(
-                    "%d Canvas imports complete, %d failed, %d processing",
-                    len(completed),
-                    len(failed),
-                    count_processing
+        self.job_store = open_job_store()
+        try:
+            if csv_path:
+                self._import_csv(csv_path)
+            else:
+                self._import_isite(keyword, canvas_course_id)
+            self.run_imports(options.get('max_in_flight'))
+        finally:
+            if self.job_store:
+                self.job_store.close()
+
+    def run_imports(self, max_in_flight=None, source=None, queue_size=None):
+        """
+        Submits the queued imports and polls them until every one has finished. source is an optional Queue of
+        further (keyword, canvas_course_id) pairs, ended by None, that are queued as they arrive, which lets
+        migrate_files import keywords while others are still being exported. Nothing more is read from source while
+        queue_size or more archives are waiting to be submitted, so source fills up and its producer waits.
+        """
+        self.admission = CanvasAdmission(
+            max_in_flight or settings.CANVAS_IMPORT_MAX_IN_FLIGHT,
+            settings.CANVAS_IMPORT_RATE_LIMIT_LOW_WATER,
+            settings.CANVAS_IMPORT_RATE_LIMIT_MAX_DELAY
+        )
+        poller = ProgressPoller(
+            self._get_progress,
+            settings.CANVAS_IMPORT_POLL_THREADS,
+            settings.CANVAS_IMPORT_POLL_MIN_INTERVAL,
+            settings.CANVAS_IMPORT_POLL_MAX_INTERVAL,
+            settings.CANVAS_IMPORT_POLL_MAX_ERRORS
+        )
+
+        completed = self.completed_imports
+        failed = self.failed_imports
+        try:
+            while source is not None or self.pending_imports or self.resumed_imports or poller:
+                # With nothing else to do, wait for the next import to arrive
+                block = not (self.pending_imports or poller)
+                if source is not None and self._read_imports(source, block, queue_size):
+                    source = None
+                self._submit_imports(poller)
+                finished_imports = set()
+                for migration in poller.poll():
+                    keyword, canvas_course_id, key_name = migration.key
+                    self.admission.record_finished()
+                    if migration.failed:
+                        logger.error(
+                            "Canvas import of %s to Canvas course %s failed",
+                            key_name,
+                            canvas_course_id
+                        )
+                        failed.add((keyword, canvas_course_id))
+                        self._set_import_state(keyword, canvas_course_id, FAILED)
+                    self._set_migration_state(
+                        keyword,
+                        canvas_course_id,
+                        key_name,
+                        migration.workflow_state,
+                        migration.progress_url
+                    )
+                    del self.canvas_progress_urls[migration.key]
+                    finished_imports.add((keyword, canvas_course_id))
+
+                if not finished_imports:
+                    continue
+
+                # A keyword exported in several parts is complete in a course once every part has been imported into it
+                processing = set(
+                    (keyword, canvas_course_id) for (keyword, canvas_course_id, key_name) in self.canvas_progress_urls
                 )
+                processing.update(
+                    (keyword, canvas_course_id) for (keyword, key_name, canvas_course_id) in self.pending_imports
+                )
+                for (keyword, canvas_course_id) in finished_imports:
+                    if (keyword, canvas_course_id) in processing or (keyword, canvas_course_id) in failed:
+                        continue
+                    self._complete_import(keyword, canvas_course_id)
+
+                count_processing = len(processing)
+                if count_processing:
+                    logger.info(
+                        "%d Canvas imports complete, %d failed, %d processing (%d archives waiting, %d of %d content "
+                        "migrations in flight)",
+                        len(completed),
+                        len(failed),
+                        count_processing,
+                        len(self.pending_imports),
+                        len(poller),
+                        self.admission.limit
+                    )
+        finally:
+            poller.close()
+            poller.log_stats()
 
         logger.info(
             "Completed import of %d iSites file exports, %d successful %d failed.",
-            import_count,
+            len(self.imports),
             len(completed),
             len(failed)
         )
@@ -117,67 +218,223 @@ class Command(BaseCommand):
                 for row in csv.reader(csv_file):
                     self._import_isite(row[0], row[1])
         except (IOError, IndexError):
-            raise CommandError("Failed to read csv file %s", csv_path)
+            raise CommandError("Failed to read csv file %s" % csv_path)
 
     def _import_isite(self, keyword, canvas_course_id):
+        """
+        Queues the keyword's export archives for import into the Canvas course
+        """
+        self.imports.add((keyword, canvas_course_id))
+        migrations = {}
+        if self.resume:
+            if self.job_store.get_import_state(keyword, canvas_course_id) == COMPLETED:
+                logger.info(
+                    "Skipping import for keyword %s and canvas_course_id %s, an earlier run already completed it",
+                    keyword,
+                    canvas_course_id
+                )
+                self.completed_imports.add((keyword, canvas_course_id))
+                return
+            migrations = self.job_store.get_migrations(keyword, canvas_course_id)
+
+        try:
+            self._set_import_state(keyword, canvas_course_id, IMPORTING)
+            all_completed = True
+            # Every part of a split export unpacks into the same unpublished_isites_archive_<keyword> folder
+            for key_name in self._get_export_key_names(keyword):
+                state, progress_url = migrations.get(key_name, (None, None))
+                if state == COMPLETED:
+                    continue
+                all_completed = False
+                if state == RUNNING:
+                    logger.info("Resuming polling of Canvas content migration %s for %s", progress_url, key_name)
+                    self.resumed_imports.append((keyword, key_name, canvas_course_id, progress_url))
+                else:
+                    self.pending_imports.append((keyword, key_name, canvas_course_id))
+            # An earlier run imported every part but stopped before locking the folder
+            if all_completed:
+                self._complete_import(keyword, canvas_course_id)
+        except Exception:
+            logger.exception(
+                "Failed to complete import for keyword %s and canvas_course_id %s",
+                keyword,
+                canvas_course_id
+            )
+            self.failed_imports.add((keyword, canvas_course_id))
+            self._set_import_state(keyword, canvas_course_id, FAILED)
+
+    def _read_imports(self, source, block, queue_size=None):
+        """
+        Queues the imports waiting in source, first waiting for one if block is set, until queue_size archives are
+        waiting to be submitted. Returns True once source has ended.
+        """
+        while not queue_size or len(self.pending_imports) < queue_size:
+            try:
+                # A timeout keeps the wait interruptible
+                item = source.get(block, 1)
+            except Empty:
+                return False
+            if item is None:
+                return True
+            self._import_isite(*item)
+            block = False
+        return False
+
+    def _submit_imports(self, poller):
+        """
+        Starts queued imports until as many content migrations are in flight as CanvasAdmission allows, waiting
+        between submissions while Canvas's rate limit quota is low
+        """
+        for keyword, key_name, canvas_course_id, progress_url in self.resumed_imports:
+            self.canvas_progress_urls[(keyword, canvas_course_id, key_name)] = progress_url
+            poller.add((keyword, canvas_course_id, key_name), canvas_course_id, progress_url)
+        self.resumed_imports = []
+
+        while self.pending_imports and len(poller) < self.admission.limit:
+            delay = self.admission.get_delay()
+            if delay:
+                logger.debug("Waiting %.1f seconds for the Canvas rate limit", delay)
+                time.sleep(delay)
+            self._start_import(poller, *self.pending_imports.popleft())
+
+    def _start_import(self, poller, keyword, key_name, canvas_course_id):
+        if (keyword, canvas_course_id) in self.failed_imports:
+            logger.info("Skipping import of %s, another part of keyword %s failed", key_name, keyword)
+            return
+
         try:
             root_folder = self._get_root_folder_for_canvas_course(canvas_course_id)
-            export_file_url = self._get_export_s3_url(keyword)
-            logger.info("Importing iSites file export from %s to Canvas course %s", export_file_url, canvas_course_id)
-            response = json.loads(content_migrations.create_content_migration_courses(
-                SDK_CONTEXT,
-                canvas_course_id,
-                'zip_file_importer',
-                settings_file_url=self._get_export_s3_url(keyword),
-                settings_folder_id=root_folder['id']
-            ).text)
-            progress_url = response['progress_url']
-            self.canvas_progress_urls[keyword] = (canvas_course_id, progress_url)
+            # Signed just before submission, so the URL is still valid when Canvas starts the migration
+            export_file_url = self._get_export_s3_url(key_name)
             logger.info(
-                "Created Canvas content migration %s for import from %s to Canvas course %s",
-                progress_url,
+                "Importing iSites file export from %s to Canvas course %s",
                 export_file_url,
                 canvas_course_id
             )
-        except Exception:
+            response = content_migrations.create_content_migration_courses(
+                get_canvas_context(),
+                canvas_course_id,
+                'zip_file_importer',
+                settings_file_url=export_file_url,
+                settings_folder_id=root_folder['id']
+            )
+        except Exception as e:
+            if isinstance(e, CanvasAPIError) and is_rate_limited(e.status_code, str(e)):
+                self.admission.record_throttled()
+                self.pending_imports.appendleft((keyword, key_name, canvas_course_id))
+                return
             logger.exception(
                 "Failed to complete import for keyword %s and canvas_course_id %s",
                 keyword,
                 canvas_course_id
             )
+            self.failed_imports.add((keyword, canvas_course_id))
+            self._set_import_state(keyword, canvas_course_id, FAILED)
+            return
 
-    def _get_export_s3_url(self, keyword):
+        self.admission.record_response(response)
+        progress_url = json.loads(response.text)['progress_url']
+        self.canvas_progress_urls[(keyword, canvas_course_id, key_name)] = progress_url
+        self._set_migration_state(keyword, canvas_course_id, key_name, RUNNING, progress_url)
+        poller.add((keyword, canvas_course_id, key_name), canvas_course_id, progress_url)
+        logger.info(
+            "Created Canvas content migration %s for import from %s to Canvas course %s",
+            progress_url,
+            export_file_url,
+            canvas_course_id
+        )
+
+    def _complete_import(self, keyword, canvas_course_id):
+        """
+        Locks the import folder once every part of the keyword has been imported into the course. A failure only fails
+        this import, the others carry on.
+        """
         try:
-            key = self.bucket.get_key("%s.zip" % keyword)
-        except boto.exception.S3ResponseError:
-            raise CommandError(
-                "iSites file export for keyword %s does not exist in S3 bucket %s", keyword, self.bucket.name
+            self._lock_canvas_folder(canvas_course_id, settings.CANVAS_IMPORT_FOLDER_PREFIX + keyword)
+        except Exception:
+            logger.exception(
+                "Failed to complete import for keyword %s and canvas_course_id %s",
+                keyword,
+                canvas_course_id
             )
+            self.failed_imports.add((keyword, canvas_course_id))
+            self._set_import_state(keyword, canvas_course_id, FAILED)
+            return
+        self.completed_imports.add((keyword, canvas_course_id))
+        self._set_import_state(keyword, canvas_course_id, COMPLETED)
+
+    def _set_import_state(self, keyword, canvas_course_id, state):
+        if self.job_store is not None:
+            self.job_store.set_import_state(keyword, canvas_course_id, state)
+
+    def _set_migration_state(self, keyword, canvas_course_id, key_name, state, progress_url):
+        if self.job_store is not None:
+            self.job_store.set_migration_state(keyword, canvas_course_id, key_name, state, progress_url)
+
+    def _get_progress(self, progress_url):
+        response = get_canvas_context().session.request('GET', progress_url)
+        self.admission.record_response(response)
+        if is_rate_limited(response.status_code, response.text):
+            self.admission.record_throttled()
+        response.raise_for_status()
+        return json.loads(response.text)
 
-        return key.generate_url(settings.AWS_EXPORT_DOWNLOAD_TIMEOUT_SECONDS)
+    def _get_export_key_names(self, keyword):
+        """
+        Returns the S3 keys of the keyword's export archives, from its export manifest
+        """
+        manifest = ExportManifest.load(self.bucket, keyword)
+        if manifest is None:
+            return ["%s.zip" % keyword]
+        return manifest.archive_keys
+
+    def _get_export_s3_url(self, key_name):
+        """
+        Returns a newly signed URL for key_name, valid for AWS_EXPORT_DOWNLOAD_TIMEOUT_SECONDS. The key names come from
+        the export manifest, so the URL is signed locally without looking the key up in S3.
+        """
+        return Key(self.bucket, key_name).generate_url(settings.AWS_EXPORT_DOWNLOAD_TIMEOUT_SECONDS)
 
     def _get_root_folder_for_canvas_course(self, canvas_course_id):
-        return json.loads(files.get_folder_courses(
-            SDK_CONTEXT,
-            canvas_course_id,
-            'root'
-        ).text)
+        root_folder = self._root_folders.get(canvas_course_id)
+        if root_folder is None:
+            root_folder = self._root_folders[canvas_course_id] = json.loads(files.get_folder_courses(
+                get_canvas_context(),
+                canvas_course_id,
+                'root'
+            ).text)
+        return root_folder
 
     def _get_import_folder(self, canvas_course_id, folder_name):
+        """
+        Finds folder_name in the course's root folder, reading the folder list a page at a time and stopping at the
+        page that has it. Every folder seen is cached, so other keywords imported into the same course rarely need
+        another listing.
+        """
+        import_folder = self._import_folders.get((canvas_course_id, folder_name))
+        if import_folder is not None:
+            return import_folder
+
         root = self._get_root_folder_for_canvas_course(canvas_course_id)
-        folders = json.loads(files.list_folders(SDK_CONTEXT, root['id']).text)
-        import_folder = None
-        for folder in folders:
-            if folder['name'] == folder_name:
-                import_folder = folder
-                break
-        return import_folder
+        response = files.list_folders(get_canvas_context(), root['id'], per_page=FOLDER_LIST_PER_PAGE)
+        while True:
+            for folder in json.loads(response.text):
+                self._import_folders[(canvas_course_id, folder['name'])] = folder
+                if folder['name'] == folder_name:
+                    return folder
+            next_page = response.links.get('next')
+            if next_page is None:
+                return None
+            response = get_canvas_context().session.request('GET', next_page['url'])
+            response.raise_for_status()
 
     def _lock_canvas_folder(self, canvas_course_id, folder_name):
         import_folder = self._get_import_folder(canvas_course_id, folder_name)
+        if import_folder is None:
+            raise CommandError("Import folder %s not found for canvas_course_id %s" % (folder_name, canvas_course_id))
         try:
             files.update_folder(
-                SDK_CONTEXT,
+                get_canvas_context(),
                 import_folder['id'],
                 import_folder['name'],
                 import_folder['parent_folder_id'],
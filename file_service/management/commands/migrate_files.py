@@ -1,12 +1,23 @@
+import csv
 import logging
+import threading
+import time
 import ssl
 if hasattr(ssl, '_create_unverified_context'):
     ssl._create_default_https_context = ssl._create_unverified_context
 
+from collections import defaultdict
 from optparse import make_option
+from Queue import Full, Queue
 
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.core.management import call_command
+from django.db import connection as db_connection
+
+from file_service.job_store import open_job_store
+from file_service.management.commands import export_files, import_files
+from file_service.work_queue import get_work_queue
 
 
 logger = logging.getLogger(__name__)
@@ -36,20 +47,218 @@ class Command(BaseCommand):
             default=None,
             help='Provide the path to a csv file containing iSites keyword/Canvas course ID pairs'
         ),
+        make_option(
+            '--pipeline',
+            action='store_true',
+            dest='pipeline',
+            default=False,
+            help='Import each keyword of a --csv batch as soon as its export has finished, instead of exporting the '
+                 'whole batch first'
+        ),
+        make_option(
+            '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=settings.EXPORT_FILES_WORKERS,
+            help='Number of keywords to export concurrently'
+        ),
+        make_option(
+            '--max_in_flight',
+            action='store',
+            type='int',
+            dest='max_in_flight',
+            default=None,
+            help='Maximum number of Canvas content migrations running at once, defaults to CANVAS_IMPORT_MAX_IN_FLIGHT'
+        ),
+        make_option(
+            '--queue_size',
+            action='store',
+            type='int',
+            dest='queue_size',
+            default=settings.MIGRATE_FILES_QUEUE_SIZE,
+            help='Number of exported keywords that can wait for the import stage of a --pipeline migration before '
+                 'exports pause'
+        ),
+        make_option(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Skip exports and imports that an earlier run recorded as complete in the MIGRATION_JOB_STORE '
+                 'database and resume polling the content migrations it left running'
+        ),
+        make_option(
+            '--distributed',
+            action='store_true',
+            dest='distributed',
+            default=False,
+            help='Enqueue the keywords of a --csv batch on the Redis work queue, for export_files --from_queue workers '
+                 'on any host to export, and import each keyword as soon as a worker has exported it'
+        ),
+        make_option(
+            '--queue_name',
+            action='store',
+            dest='queue_name',
+            default=settings.WORK_QUEUE_NAME,
+            help='Name of the Redis work queue used by --distributed'
+        ),
     )
 
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.canvas_course_ids = defaultdict(list)
+        self.queued_keywords = set()
+        self.exported = None
+        self.stopped = threading.Event()
+        self._queued_lock = threading.Lock()
+
     def handle(self, *args, **options):
         keyword = options.get('keyword')
         canvas_course_id = options.get('canvas_course_id')
         csv_path = options.get('csv_path')
+        workers = options.get('workers')
+        max_in_flight = options.get('max_in_flight')
+        resume = options.get('resume', False)
 
-        if csv_path:
-            call_command('export_files', csv_path=csv_path)
-            call_command('import_files', csv_path=csv_path)
+        if csv_path and options.get('distributed'):
+            work_queue = get_work_queue(options.get('queue_name'))
+            self._migrate_pipelined(csv_path, workers, max_in_flight, options.get('queue_size'), resume, work_queue)
+        elif csv_path and options.get('pipeline'):
+            self._migrate_pipelined(csv_path, workers, max_in_flight, options.get('queue_size'), resume)
+        elif csv_path:
+            call_command('export_files', csv_path=csv_path, workers=workers, resume=resume)
+            call_command('import_files', csv_path=csv_path, max_in_flight=max_in_flight, resume=resume)
         elif keyword and canvas_course_id:
-            call_command('export_files', keyword=keyword, canvas_course_id=canvas_course_id)
-            call_command('import_files', keyword=keyword, canvas_course_id=canvas_course_id)
+            call_command('export_files', keyword=keyword, canvas_course_id=canvas_course_id, resume=resume)
+            call_command('import_files', keyword=keyword, canvas_course_id=canvas_course_id,
+                         max_in_flight=max_in_flight, resume=resume)
         else:
             raise CommandError(
                 'You must provide either the --keyword and --canvas_course_id options or the --csv option.'
             )
+
+    def _migrate_pipelined(self, csv_path, workers, max_in_flight, queue_size, resume, work_queue=None):
+        """
+        Exports the batch on a background thread and imports each keyword as soon as its export has finished, so
+        Canvas is busy importing while later keywords are still being exported. Exported keywords are handed over
+        through a queue of at most queue_size, which the import stage stops reading while queue_size archives are
+        waiting for Canvas, so the exports pause whenever the import stage falls behind. If the import stage fails,
+        keywords that have not been started are not exported.
+        Given a work_queue, the keywords are enqueued on it instead and the background thread hands over the keywords
+        that export_files --from_queue workers have finished.
+        """
+        if resume and not settings.MIGRATION_JOB_STORE:
+            raise CommandError('--resume needs the MIGRATION_JOB_STORE setting.')
+        try:
+            with open(csv_path, 'rU') as csv_file:
+                for row in csv.reader(csv_file):
+                    if row[1] not in self.canvas_course_ids[row[0]]:
+                        self.canvas_course_ids[row[0]].append(row[1])
+        except (IOError, IndexError):
+            raise CommandError("Failed to read csv file %s" % csv_path)
+
+        logger.info(
+            "Migrating %d iSites keywords from csv %s with exports and imports pipelined",
+            len(self.canvas_course_ids),
+            csv_path
+        )
+        self.exported = Queue(max(queue_size, 1))
+        if work_queue is not None:
+            if not work_queue.is_drained():
+                raise CommandError(
+                    "Work queue %s still has keywords pending or being exported, wait for its workers to finish or "
+                    "use another --queue_name" % work_queue.name
+                )
+            work_queue.clear()
+            work_queue.enqueue(list(self.canvas_course_ids))
+            export_thread = threading.Thread(
+                target=self._read_work_queue,
+                args=(work_queue,),
+                name='migrate_files-work-queue'
+            )
+        else:
+            export_command = export_files.Command()
+            export_command.exported_callback = self._queue_import
+            # Set below if the import stage fails, so no further keywords are exported
+            export_command.stopped = self.stopped
+            export_thread = threading.Thread(
+                target=self._run_export,
+                args=(export_command, csv_path, workers, resume),
+                name='migrate_files-export'
+            )
+        import_command = import_files.Command()
+        import_command.resume = resume
+        import_command.job_store = open_job_store()
+        export_thread.start()
+        try:
+            import_command.run_imports(max_in_flight, source=self.exported, queue_size=queue_size)
+        finally:
+            if export_thread.is_alive():
+                logger.info("Waiting for the exports in progress to finish")
+            # Stops the export stage from starting more keywords or waiting on the queue if the import stage failed
+            self.stopped.set()
+            export_thread.join()
+            if import_command.job_store:
+                import_command.job_store.close()
+
+    def _run_export(self, export_command, csv_path, workers, resume):
+        try:
+            self._call_command(export_command, 'export_files', csv_path=csv_path, workers=workers, resume=resume)
+        except Exception:
+            logger.exception("Export stage of the migration from csv %s failed", csv_path)
+        finally:
+            db_connection.close()
+            self._put(None)
+
+    def _read_work_queue(self, work_queue):
+        try:
+            while not self.stopped.is_set():
+                # Checked first, so anything finished before the queue drained is still read below
+                drained = work_queue.is_drained()
+                item = work_queue.pop_finished()
+                if item is None:
+                    if drained:
+                        break
+                    time.sleep(settings.WORK_QUEUE_POLL_INTERVAL)
+                    continue
+                keyword, exported = item
+                if exported:
+                    self._queue_import(keyword)
+                else:
+                    logger.error("Export of keyword %s failed on every attempt, it will not be imported", keyword)
+        except Exception:
+            logger.exception("Failed to read work queue %s", work_queue.name)
+        finally:
+            self._put(None)
+
+    def _call_command(self, command, name, **options):
+        """
+        Runs an already created command instance with the option defaults call_command would give it, so callbacks
+        can be set on it first
+        """
+        parser = command.create_parser('', name)
+        defaults, _ = parser.parse_args(args=[])
+        defaults = dict(defaults.__dict__, **options)
+        defaults.setdefault('skip_checks', True)
+        return command.execute(**defaults)
+
+    def _queue_import(self, keyword):
+        # Each keyword is imported once, even if it is handed over again
+        with self._queued_lock:
+            if keyword in self.queued_keywords:
+                return
+            self.queued_keywords.add(keyword)
+        for canvas_course_id in self.canvas_course_ids.get(keyword, []):
+            self._put((keyword, canvas_course_id))
+
+    def _put(self, item):
+        """
+        Adds item to the queue of exported keywords, waiting while it is full unless the import stage has stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                self.exported.put(item, timeout=1)
+                return
+            except Full:
+                continue
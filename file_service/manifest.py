@@ -0,0 +1,170 @@
+import json
+import logging
+
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+
+from kitchen.text.converters import to_unicode
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def get_manifest_key_name(keyword):
+    return "%s.manifest.json" % keyword
+
+
+def _isoformat(value):
+    if value is None:
+        return None
+    return value.isoformat()
+
+
+class ExportManifest(object):
+    """
+    Records what went into a keyword's export archive: the file_node_id, last_modified, file_size and archive path of
+    every FileNode, the same for every TopicText, the checksums of each entry as it was written and the archive parts
+    the keyword was split into, with their checksums and S3 ETags. It is stored next to <keyword>.zip after the archive
+    upload completes, so an incremental export can tell from the database alone whether an archive is still current,
+    and import_files knows which archives to import. FileNodes whose source could not be read are marked unreadable,
+    which counts as a change, so the next incremental export retries them.
+    """
+
+    def __init__(self, keyword, file_nodes=None, topic_texts=None):
+        self.keyword = keyword
+        self.file_nodes = file_nodes or {}
+        self.topic_texts = topic_texts or {}
+        self.archive_parts = []
+
+    @classmethod
+    def from_plan(cls, plan):
+        """
+        Builds the manifest a KeywordExportPlan is expected to produce, without checksums
+        """
+        manifest = cls(plan.keyword)
+        for topic_export in plan.topic_exports:
+            for file_node in topic_export.file_nodes:
+                manifest.file_nodes[file_node.file_node_id] = {
+                    'file_node_id': file_node.file_node_id,
+                    'path': to_unicode(topic_export.get_file_node_arcname(file_node)),
+                    'last_modified': _isoformat(file_node.last_modified),
+                    'file_size': file_node.file_size,
+                    'checksums': None,
+                }
+            for topic_text in topic_export.topic_texts:
+                manifest.topic_texts[topic_text.text_id] = {
+                    'text_id': topic_text.text_id,
+                    'path': to_unicode(topic_export.get_topic_text_arcname(topic_text)),
+                    'modified_on': _isoformat(topic_text.modified_on),
+                    'checksums': None,
+                }
+        return manifest
+
+    @classmethod
+    def load(cls, bucket, keyword):
+        """
+        Returns the manifest stored for keyword, or None if there is no readable manifest. Reads it with a single GET.
+        """
+        key = Key(bucket, get_manifest_key_name(keyword))
+        try:
+            contents = key.get_contents_as_string()
+        except S3ResponseError as e:
+            if e.status == 404:
+                return None
+            raise
+        try:
+            data = json.loads(contents)
+        except ValueError:
+            logger.exception("Ignoring unreadable export manifest %s", key.name)
+            return None
+        if data.get('version') != MANIFEST_VERSION:
+            logger.info("Ignoring export manifest %s with version %s", key.name, data.get('version'))
+            return None
+
+        manifest = cls(
+            data['keyword'],
+            dict((entry['file_node_id'], entry) for entry in data['file_nodes']),
+            dict((entry['text_id'], entry) for entry in data['topic_texts'])
+        )
+        manifest.archive_parts = data.get('archive_parts', [])
+        return manifest
+
+    def save(self, bucket):
+        key = Key(bucket)
+        key.key = get_manifest_key_name(self.keyword)
+        key.set_metadata('Content-Type', 'application/json')
+        key.set_contents_from_string(json.dumps(self.to_dict(), sort_keys=True))
+        logger.info("Uploaded export manifest for keyword %s to S3 Key %s", self.keyword, key.key)
+
+    def to_dict(self):
+        return {
+            'version': MANIFEST_VERSION,
+            'keyword': self.keyword,
+            'archive_parts': self.archive_parts,
+            'file_nodes': [self.file_nodes[k] for k in sorted(self.file_nodes)],
+            'topic_texts': [self.topic_texts[k] for k in sorted(self.topic_texts)],
+        }
+
+    @property
+    def archive_keys(self):
+        """
+        The S3 keys of the keyword's archives, in part order
+        """
+        if not self.archive_parts:
+            return ["%s.zip" % self.keyword]
+        return [part['key'] for part in self.archive_parts]
+
+    def add_archive_part(self, key_name, size, entries, checksums=None, etag=None):
+        self.archive_parts.append({
+            'key': key_name,
+            'size': size,
+            'entries': entries,
+            'checksums': checksums,
+            'etag': etag,
+        })
+
+    def record_file_node(self, file_node_id, checksums):
+        self.file_nodes[file_node_id]['checksums'] = checksums
+
+    def record_unreadable_file_node(self, file_node_id):
+        self.file_nodes[file_node_id]['unreadable'] = True
+
+    def record_topic_text(self, text_id, checksums):
+        self.topic_texts[text_id]['checksums'] = checksums
+
+    @property
+    def fingerprint(self):
+        """
+        The database state the archive was built from, ignoring checksums
+        """
+        return (
+            sorted(
+                (
+                    entry['file_node_id'],
+                    entry['path'],
+                    entry['last_modified'],
+                    entry['file_size'],
+                    entry.get('unreadable', False)
+                )
+                for entry in self.file_nodes.values()
+            ),
+            sorted(
+                (entry['text_id'], entry['path'], entry['modified_on'])
+                for entry in self.topic_texts.values()
+            ),
+        )
+
+    def changes_from(self, previous):
+        """
+        Returns the number of FileNodes and TopicTexts that were added, removed or changed since previous
+        """
+        changes = 0
+        for current_entries, previous_entries in zip(self.fingerprint, previous.fingerprint):
+            current_entries = dict((entry[0], entry) for entry in current_entries)
+            previous_entries = dict((entry[0], entry) for entry in previous_entries)
+            for entry_id in set(current_entries) | set(previous_entries):
+                if current_entries.get(entry_id) != previous_entries.get(entry_id):
+                    changes += 1
+        return changes
@@ -0,0 +1,168 @@
+"""
+Concurrent polling of Canvas content migration progress.
+
+A batch import can have a thousand content migrations in flight. Polling each progress URL in turn every couple of
+seconds means a single sweep takes far longer than the interval, and most requests go to migrations that were only just
+queued. ProgressPoller polls the migrations that are due from a thread pool, and gives each migration its own interval
+from its workflow_state and how long it has been running, so short imports are noticed quickly and long ones are not
+polled needlessly.
+"""
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+from file_service.canvas_admission import is_rate_limited
+
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationProgress(object):
+    """
+    Polling state of one content migration
+    """
+
+    def __init__(self, key, canvas_course_id, progress_url, started):
+        self.key = key
+        self.canvas_course_id = canvas_course_id
+        self.progress_url = progress_url
+        self.started = started
+        self.next_poll = started
+        self.polls = 0
+        self.errors = 0
+        self.workflow_state = None
+        self.completion = None
+
+    @property
+    def finished(self):
+        return self.workflow_state in ProgressPoller.FINISHED_STATES
+
+    @property
+    def failed(self):
+        return self.workflow_state == 'failed'
+
+
+class ProgressPoller(object):
+    """
+    Polls migrations added with add() on threads threads. get_progress is called with a progress URL and returns the
+    Canvas Progress object as a dict. Each migration is polled again after a fraction of the time it has been running,
+    kept between min_interval and max_interval seconds. Migrations still queued behind others are polled half as often,
+    and running migrations that report their completion are polled about twice before they are expected to finish.
+    A migration is marked failed once max_errors polls in a row have failed, or straight away if Canvas answers with a
+    client error other than throttling, such as for a progress URL that no longer exists.
+    """
+    FINISHED_STATES = ('completed', 'failed')
+    ELAPSED_FRACTION = 0.1
+    QUEUED_STATES = ('queued',)
+
+    def __init__(self, get_progress, threads, min_interval, max_interval, max_errors):
+        self.get_progress = get_progress
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.max_errors = max(max_errors, 1)
+        self.polls = 0
+        self.finished_count = 0
+        self._pending = {}
+        self._pool = ThreadPool(max(threads, 1))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, canvas_course_id, progress_url):
+        """
+        Starts polling progress_url. key identifies the migration and must be unique among the migrations being polled.
+        """
+        now = time.time()
+        migration = MigrationProgress(key, canvas_course_id, progress_url, now)
+        migration.next_poll = now + self.min_interval
+        self._pending[key] = migration
+
+    def poll(self):
+        """
+        Waits until at least one migration is due, polls every due migration concurrently and returns the migrations
+        that finished, which are no longer polled
+        """
+        if not self._pending:
+            return []
+        delay = min(migration.next_poll for migration in self._pending.values()) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        now = time.time()
+        due = [migration for migration in self._pending.values() if migration.next_poll <= now]
+        self._pool.map(self._poll, due)
+        self.polls += len(due)
+
+        finished = [migration for migration in due if migration.finished]
+        for migration in finished:
+            del self._pending[migration.key]
+            self.finished_count += 1
+            logger.info(
+                "Canvas content migration %s %s after %d polls in %.0f seconds",
+                migration.progress_url,
+                migration.workflow_state,
+                migration.polls,
+                time.time() - migration.started
+            )
+        return finished
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def log_stats(self):
+        logger.info(
+            "Issued %d Canvas progress polls for %d finished imports (%.1f polls per import), %d still pending",
+            self.polls,
+            self.finished_count,
+            self.polls / float(max(self.finished_count, 1)),
+            len(self._pending)
+        )
+
+    def _poll(self, migration):
+        migration.polls += 1
+        try:
+            progress = self.get_progress(migration.progress_url)
+        except Exception as e:
+            migration.errors += 1
+            if migration.errors >= self.max_errors or self._is_client_error(e):
+                logger.error(
+                    "Failed to poll Canvas content migration %s (%d in a row), giving up on it",
+                    migration.progress_url,
+                    migration.errors,
+                    exc_info=True
+                )
+                migration.workflow_state = 'failed'
+                return
+            logger.warning(
+                "Failed to poll Canvas content migration %s (%d in a row), retrying",
+                migration.progress_url,
+                migration.errors,
+                exc_info=True
+            )
+        else:
+            migration.errors = 0
+            migration.workflow_state = progress.get('workflow_state')
+            migration.completion = progress.get('completion')
+        migration.next_poll = time.time() + self._get_interval(migration)
+
+    def _is_client_error(self, error):
+        """
+        Whether error is an HTTP error response with a 4xx status that retrying will not fix
+        """
+        response = getattr(error, 'response', None)
+        status_code = getattr(response, 'status_code', None)
+        if status_code is None or not 400 <= status_code < 500:
+            return False
+        return not is_rate_limited(status_code, response.text)
+
+    def _get_interval(self, migration):
+        elapsed = time.time() - migration.started
+        interval = elapsed * self.ELAPSED_FRACTION
+        if migration.errors or migration.workflow_state in self.QUEUED_STATES:
+            interval *= 2
+        elif migration.completion:
+            # Estimate the time left from the rate at which completion has risen so far
+            remaining = elapsed * (100.0 - migration.completion) / migration.completion
+            interval = min(interval, remaining / 2)
+        return min(max(interval, self.min_interval), self.max_interval)
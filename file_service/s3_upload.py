@@ -0,0 +1,288 @@
+"""
+Uploads to S3 shared by the export commands.
+
+Large uploads are sent as S3 multipart uploads with several parts in flight at once, so a multi-GB archive is not
+limited to a single TCP connection. A failed part is retried on its own instead of restarting the whole upload.
+The MD5 of each upload or part is sent with it, from digests computed while the data was produced where possible, and
+the ETag S3 returns is checked against it, so what was stored is verified without reading anything back.
+Every upload logs its throughput. Any boto Bucket can be passed in, including one for a local S3 stand-in (see
+file_service.clients.connect_s3).
+"""
+import binascii
+import hashlib
+import logging
+import os
+import time
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from boto.s3.key import Key
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadVerificationError(Exception):
+    pass
+
+
+def get_md5(hexdigest):
+    """
+    Returns the (hex digest, base64 digest) pair boto accepts as a precomputed md5
+    """
+    return hexdigest, binascii.b2a_base64(binascii.unhexlify(hexdigest)).strip()
+
+
+def get_multipart_etag(part_digests):
+    """
+    Returns the ETag S3 gives a multipart upload: the MD5 of the concatenated binary part MD5s and the part count
+    """
+    return "%s-%d" % (hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+def verify_etag(key_name, etag, expected):
+    etag = (etag or '').strip('"')
+    if not settings.AWS_UPLOAD_VERIFY_ETAG:
+        return etag
+    if etag != expected:
+        raise UploadVerificationError("S3 Key %s has ETag %s, expected %s" % (key_name, etag, expected))
+    logger.debug("Verified S3 Key %s against ETag %s", key_name, etag)
+    return etag
+
+
+def verify_upload(bucket, key_name, etag, expected):
+    """
+    Verifies the ETag of an upload to key_name that has completed, deleting the Key if it does not match so that an
+    object that failed verification is never left at its real name
+    """
+    try:
+        return verify_etag(key_name, etag, expected)
+    except UploadVerificationError:
+        try:
+            bucket.delete_key(key_name)
+        except Exception:
+            logger.exception("Failed to delete unverified S3 Key %s", key_name)
+        raise
+
+
+def with_retries(description, func, *args, **kwargs):
+    """
+    Calls func, retrying up to AWS_UPLOAD_ATTEMPTS times in total with exponential backoff
+    """
+    attempts = max(settings.AWS_UPLOAD_ATTEMPTS, 1)
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if attempt == attempts:
+                raise
+            delay = settings.AWS_UPLOAD_RETRY_DELAY * 2 ** (attempt - 1)
+            logger.warning(
+                "%s failed on attempt %d of %d, retrying in %d seconds",
+                description,
+                attempt,
+                attempts,
+                delay,
+                exc_info=True
+            )
+            time.sleep(delay)
+
+
+def upload_file(bucket, key_name, filename, content_type=None, md5=None):
+    """
+    Uploads filename to key_name, in parallel parts if it is at least AWS_MULTIPART_THRESHOLD bytes, and returns the
+    verified ETag. md5 is the hex MD5 of the file if it is already known, which saves boto reading the file an extra
+    time to compute it for a single PUT.
+    """
+    size = os.path.getsize(filename)
+    if size < settings.AWS_MULTIPART_THRESHOLD:
+        key = Key(bucket, key_name)
+        if content_type:
+            key.set_metadata('Content-Type', content_type)
+        started = time.time()
+        with_retries(
+            "Upload to S3 Key %s" % key_name,
+            key.set_contents_from_filename,
+            filename,
+            md5=get_md5(md5) if md5 else None
+        )
+        _log_upload(key_name, size, 1, time.time() - started)
+        return verify_upload(bucket, key_name, key.etag, key.md5)
+
+    upload = MultipartUploadWriter(bucket, key_name, content_type=content_type)
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(upload.part_size)
+                if not data:
+                    break
+                upload.write(data)
+        upload.close()
+    except Exception:
+        upload.abort()
+        raise
+    return upload.etag
+
+
+def _log_upload(key_name, size, parts, elapsed):
+    logger.info(
+        "Uploaded %d bytes to S3 Key %s in %d parts in %.1f seconds (%.2f MB/s)",
+        size,
+        key_name,
+        parts,
+        elapsed,
+        size / max(elapsed, 0.001) / (1024 * 1024)
+    )
+
+
+class MultipartUploadWriter(object):
+    """
+    File-like object that uploads everything written to it to an S3 key. Data is buffered one part at a time and sent
+    as an S3 multipart upload with up to concurrency parts in flight, so memory use is bounded by
+    (concurrency + 1) * part_size however much is written. Each part is retried on its own. Writes smaller than a
+    single part are sent as a single PUT when the writer is closed. close() checks the ETag of the completed upload
+    against the MD5s of the data written and sets etag.
+    """
+
+    def __init__(self, bucket, key_name, content_type=None, part_size=None, concurrency=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.content_type = content_type
+        self.part_size = part_size or settings.AWS_MULTIPART_PART_SIZE
+        if concurrency is None:
+            concurrency = settings.AWS_MULTIPART_CONCURRENCY
+        self.concurrency = max(concurrency, 1)
+        self.bytes_written = 0
+        self.elapsed = 0.0
+        self.etag = None
+        self._part_digests = {}
+        self._buffer = BytesIO()
+        self._upload = None
+        self._part_number = 0
+        self._pool = None
+        self._in_flight = []
+        self._started = time.time()
+        self.closed = False
+        self.completed = False
+
+    @property
+    def headers(self):
+        if self.content_type:
+            return {'Content-Type': self.content_type}
+        return {}
+
+    def write(self, data):
+        self._buffer.write(data)
+        self.bytes_written += len(data)
+        if self._buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def close(self):
+        """
+        Uploads any buffered data, waits for the parts in flight and completes the upload
+        """
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            if self._upload is None:
+                key = Key(self.bucket, self.key_name)
+                data = self._buffer.getvalue()
+                md5 = hashlib.md5(data).hexdigest()
+                with_retries(
+                    "Upload to S3 Key %s" % self.key_name,
+                    lambda: key.set_contents_from_file(BytesIO(data), headers=self.headers, md5=get_md5(md5))
+                )
+                self.completed = True
+                self.etag = verify_upload(self.bucket, self.key_name, key.etag, md5)
+            else:
+                if self._buffer.tell():
+                    self._upload_part()
+                self._wait_for_parts(0)
+                completed = with_retries(
+                    "Completion of upload to S3 Key %s" % self.key_name,
+                    self._upload.complete_upload
+                )
+                self.completed = True
+                part_digests = [self._part_digests[n] for n in sorted(self._part_digests)]
+                self.etag = verify_upload(
+                    self.bucket,
+                    self.key_name,
+                    completed.etag,
+                    get_multipart_etag(part_digests)
+                )
+        finally:
+            self._buffer = None
+            self._close_pool()
+        self.elapsed = time.time() - self._started
+        _log_upload(self.key_name, self.bytes_written, max(self._part_number, 1), self.elapsed)
+
+    def abort(self):
+        """
+        Discards buffered data and cancels the multipart upload so S3 does not keep the uploaded parts. Also cancels
+        the upload if close() failed before completing it.
+        """
+        if self.completed:
+            return
+        self.closed = True
+        self._buffer = None
+        # Let parts in flight finish first, otherwise they could be stored after the cancel
+        for result in self._in_flight:
+            result.wait()
+        self._in_flight = []
+        self._close_pool()
+        upload, self._upload = self._upload, None
+        if upload is not None:
+            try:
+                upload.cancel_upload()
+            except Exception:
+                logger.exception("Failed to cancel multipart upload %s for S3 Key %s", upload.id, self.key_name)
+
+    def _upload_part(self):
+        if self._upload is None:
+            self._upload = with_retries(
+                "Start of multipart upload to S3 Key %s" % self.key_name,
+                self.bucket.initiate_multipart_upload,
+                self.key_name,
+                headers=self.headers
+            )
+            logger.debug("Started multipart upload %s for S3 Key %s", self._upload.id, self.key_name)
+
+        self._part_number += 1
+        data = self._buffer.getvalue()
+        self._buffer = BytesIO()
+        if self.concurrency == 1:
+            self._send_part(self._part_number, data)
+            return
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.concurrency)
+        self._wait_for_parts(self.concurrency - 1)
+        self._in_flight.append(self._pool.apply_async(self._send_part, (self._part_number, data)))
+
+    def _send_part(self, part_number, data):
+        digest = hashlib.md5(data).digest()
+        self._part_digests[part_number] = digest
+        md5 = get_md5(binascii.hexlify(digest).decode('ascii'))
+        # Safe from pool threads: each part is a new Key, and the bucket's S3Connection pools its HTTP connections
+        with_retries(
+            "Upload of part %d to S3 Key %s" % (part_number, self.key_name),
+            lambda: self._upload.upload_part_from_file(BytesIO(data), part_number, md5=md5, size=len(data))
+        )
+        logger.debug("Uploaded part %d (%d bytes) to S3 Key %s", part_number, len(data), self.key_name)
+
+    def _wait_for_parts(self, limit):
+        """
+        Waits until at most limit parts are in flight, raising the error of any part that failed every attempt
+        """
+        while len(self._in_flight) > limit:
+            self._in_flight.pop(0).get()
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,208 @@
+"""
+Limits concurrent file reads per storage node.
+
+Sources are spread over several StorageNode NFS mounts. With several export workers and gzip decode processes, reads
+from a naive parallel export pile up on whichever node holds the current courses. StorageNodeScheduler queues reads
+per node and admits at most a configured number at a time to each, so the nodes can be kept busy evenly without
+overloading any one of them. A slot should only be held while its source is being read, StorageNodeReader gives it
+back as soon as the source has been read to the end. Queue depth and throughput are tracked per node and logged
+periodically.
+"""
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class StorageNodeQueue(object):
+    """
+    Read slots and statistics for one storage node
+    """
+
+    def __init__(self, location, limit):
+        self.location = location
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.reads = 0
+        self.bytes_read = 0
+        self.wait_time = 0.0
+        self.started = None
+
+    @property
+    def available(self):
+        return not self.limit or self.active < self.limit
+
+    @property
+    def throughput(self):
+        """
+        Bytes read per second since the first read from this node
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.bytes_read / elapsed
+
+
+class StorageNodeSlot(object):
+    """
+    Permission to read from a storage node, released with release() or by leaving a with block
+    """
+
+    def __init__(self, scheduler, queue):
+        self.scheduler = scheduler
+        self.queue = queue
+        self.bytes_read = 0
+        self._released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self, bytes_read=None):
+        if bytes_read is not None:
+            self.bytes_read = bytes_read
+        self.scheduler._release(self)
+
+
+class StorageNodeReader(object):
+    """
+    Read only file object over a source read under a StorageNodeSlot, releasing the slot as soon as the source has
+    been read to the end or closed
+    """
+
+    def __init__(self, fileobj, slot):
+        self._file = fileobj
+        self._slot = slot
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        if not data or size is None or size < 0:
+            self._release()
+        return data
+
+    def close(self):
+        try:
+            self._file.close()
+        finally:
+            self._release()
+
+    def _release(self):
+        self._slot.release(bytes_read=self.bytes_read)
+
+
+class StorageNodeScheduler(object):
+    """
+    Thread safe per storage node read admission. Each node admits default_limit concurrent reads unless limits, a
+    dict keyed by storage node physical_location, says otherwise. A limit of 0 admits everything, which still
+    tracks statistics.
+    """
+
+    def __init__(self, default_limit, limits=None, stats_interval=60):
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.stats_interval = stats_interval
+        self._queues = {}
+        self._condition = threading.Condition()
+        self._stats_logged = time.time()
+
+    def acquire(self, location):
+        """
+        Waits for a read slot on the storage node at location
+        """
+        with self._condition:
+            queue = self._get_queue(location)
+            if not queue.available:
+                queue.waiting += 1
+                queue.max_waiting = max(queue.max_waiting, queue.waiting)
+                wait_started = time.time()
+                try:
+                    while not queue.available:
+                        self._condition.wait()
+                finally:
+                    queue.waiting -= 1
+                    queue.wait_time += time.time() - wait_started
+            return self._admit(queue)
+
+    def try_acquire(self, location):
+        """
+        Returns a read slot on the storage node at location, or None if the node is busy or has reads queued
+        """
+        with self._condition:
+            queue = self._get_queue(location)
+            if queue.waiting or not queue.available:
+                return None
+            return self._admit(queue)
+
+    def get_stats(self):
+        with self._condition:
+            return [
+                {
+                    'location': queue.location,
+                    'limit': queue.limit,
+                    'active': queue.active,
+                    'queued': queue.waiting,
+                    'max_queued': queue.max_waiting,
+                    'reads': queue.reads,
+                    'bytes_read': queue.bytes_read,
+                    'wait_time': queue.wait_time,
+                    'throughput': queue.throughput,
+                }
+                for queue in sorted(self._queues.values(), key=lambda q: q.location)
+            ]
+
+    def log_stats(self):
+        for stats in self.get_stats():
+            logger.info(
+                "Storage node %s: %d of %s read slots in use, %d queued (max %d), %d reads, %d bytes, %.2f MB/s, "
+                "%.1f seconds waiting",
+                stats['location'],
+                stats['active'],
+                stats['limit'] or 'unlimited',
+                stats['queued'],
+                stats['max_queued'],
+                stats['reads'],
+                stats['bytes_read'],
+                stats['throughput'] / (1024 * 1024),
+                stats['wait_time']
+            )
+
+    def log_stats_if_due(self):
+        with self._condition:
+            now = time.time()
+            if now - self._stats_logged < self.stats_interval:
+                return
+            self._stats_logged = now
+        self.log_stats()
+
+    def _get_queue(self, location):
+        queue = self._queues.get(location)
+        if queue is None:
+            queue = StorageNodeQueue(location, self.limits.get(location, self.default_limit))
+            self._queues[location] = queue
+        return queue
+
+    def _admit(self, queue):
+        queue.active += 1
+        queue.reads += 1
+        if queue.started is None:
+            queue.started = time.time()
+        return StorageNodeSlot(self, queue)
+
+    def _release(self, slot):
+        with self._condition:
+            if slot._released:
+                return
+            slot._released = True
+            slot.queue.active -= 1
+            slot.queue.bytes_read += slot.bytes_read
+            self._condition.notify_all()
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+from django.test import SimpleTestCase, override_settings
+
+from file_service import s3_upload
+from file_service.s3_upload import MultipartUploadWriter, UploadVerificationError, upload_file
+
+
+class FakeKey(object):
+    """
+    Stand-in for the boto Key used for single PUTs, storing its contents in a FakeBucket
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.etag = None
+        self.md5 = None
+
+    def set_metadata(self, name, value):
+        pass
+
+    def set_contents_from_filename(self, filename, md5=None):
+        with open(filename, 'rb') as f:
+            self.set_contents_from_file(f, md5=md5)
+
+    def set_contents_from_file(self, fp, headers=None, md5=None):
+        data = fp.read()
+        self.md5 = hashlib.md5(data).hexdigest()
+        self.etag = '"%s"' % (self.bucket.bad_etag or self.md5)
+        self.bucket.keys[self.name] = data
+
+
+class FakeMultipartUpload(object):
+
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = 'upload-%d' % len(bucket.uploads)
+        self.parts = {}
+        self.part_attempts = {}
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+        with self._lock:
+            self.part_attempts[part_num] = self.part_attempts.get(part_num, 0) + 1
+            if part_num in self.bucket.fail_parts_once and self.part_attempts[part_num] == 1:
+                raise IOError("Connection reset uploading part %d" % part_num)
+            self.parts[part_num] = fp.read(size)
+
+    def complete_upload(self):
+        if self.bucket.fail_complete:
+            raise IOError("Connection reset completing upload")
+        parts = [self.parts[n] for n in sorted(self.parts)]
+        self.bucket.keys[self.key_name] = b''.join(parts)
+        digests = b''.join(hashlib.md5(part).digest() for part in parts)
+        completed = FakeKey(self.bucket, self.key_name)
+        completed.etag = '"%s"' % (self.bucket.bad_etag or "%s-%d" % (hashlib.md5(digests).hexdigest(), len(parts)))
+        return completed
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class FakeBucket(object):
+    """
+    In-memory stand-in for the boto Bucket methods the uploads use
+    """
+
+    def __init__(self, fail_parts_once=(), fail_complete=False, bad_etag=None):
+        self.keys = {}
+        self.uploads = []
+        self.deleted = []
+        self.fail_parts_once = set(fail_parts_once)
+        self.fail_complete = fail_complete
+        self.bad_etag = bad_etag
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        upload = FakeMultipartUpload(self, key_name)
+        self.uploads.append(upload)
+        return upload
+
+    def delete_key(self, key_name):
+        self.deleted.append(key_name)
+        self.keys.pop(key_name, None)
+
+
+@override_settings(
+    AWS_UPLOAD_VERIFY_ETAG=True,
+    AWS_UPLOAD_ATTEMPTS=2,
+    AWS_UPLOAD_RETRY_DELAY=0,
+    AWS_MULTIPART_THRESHOLD=100,
+    AWS_MULTIPART_PART_SIZE=100,
+    AWS_MULTIPART_CONCURRENCY=2
+)
+class S3UploadTests(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, s3_upload, 'Key', s3_upload.Key)
+        s3_upload.Key = FakeKey
+        self.data = os.urandom(350)
+
+    def _write(self, bucket, data, chunk_size=25):
+        upload = MultipartUploadWriter(bucket, 'export.zip', content_type='application/zip')
+        for offset in range(0, len(data), chunk_size):
+            upload.write(data[offset:offset + chunk_size])
+        return upload
+
+    def _write_temp_file(self, data):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.addCleanup(os.remove, filename)
+        return filename
+
+    def test_small_write_is_a_single_put(self):
+        bucket = FakeBucket()
+        upload = self._write(bucket, self.data[:50])
+        upload.close()
+        self.assertEqual(bucket.keys['export.zip'], self.data[:50])
+        self.assertEqual(bucket.uploads, [])
+        self.assertEqual(upload.etag, hashlib.md5(self.data[:50]).hexdigest())
+        self.assertTrue(upload.completed)
+
+    def test_multipart_upload_is_verified_against_part_md5s(self):
+        bucket = FakeBucket()
+        upload = self._write(bucket, self.data)
+        upload.close()
+        self.assertEqual(bucket.keys['export.zip'], self.data)
+        self.assertEqual(len(bucket.uploads), 1)
+        self.assertEqual(sorted(bucket.uploads[0].parts), [1, 2, 3, 4])
+        self.assertTrue(upload.etag.endswith('-4'))
+        self.assertEqual(upload.bytes_written, len(self.data))
+        self.assertTrue(upload.completed)
+
+    def test_failed_part_is_retried_on_its_own(self):
+        bucket = FakeBucket(fail_parts_once=[2])
+        upload = self._write(bucket, self.data)
+        upload.close()
+        self.assertEqual(bucket.keys['export.zip'], self.data)
+        self.assertEqual(bucket.uploads[0].part_attempts, {1: 1, 2: 2, 3: 1, 4: 1})
+
+    @override_settings(AWS_UPLOAD_ATTEMPTS=1)
+    def test_abort_cancels_upload_that_failed_to_complete(self):
+        bucket = FakeBucket(fail_complete=True)
+        upload = self._write(bucket, self.data)
+        self.assertRaises(IOError, upload.close)
+        self.assertFalse(upload.completed)
+        upload.abort()
+        self.assertTrue(bucket.uploads[0].cancelled)
+        self.assertNotIn('export.zip', bucket.keys)
+
+    def test_abort_after_close_does_not_cancel(self):
+        bucket = FakeBucket()
+        upload = self._write(bucket, self.data)
+        upload.close()
+        upload.abort()
+        self.assertFalse(bucket.uploads[0].cancelled)
+        self.assertEqual(bucket.keys['export.zip'], self.data)
+
+    def test_unverified_multipart_upload_is_deleted(self):
+        bucket = FakeBucket(bad_etag='0' * 32)
+        upload = self._write(bucket, self.data)
+        self.assertRaises(UploadVerificationError, upload.close)
+        self.assertEqual(bucket.deleted, ['export.zip'])
+        self.assertNotIn('export.zip', bucket.keys)
+
+    def test_upload_file_in_parts(self):
+        bucket = FakeBucket()
+        filename = self._write_temp_file(self.data)
+        etag = upload_file(bucket, 'export.zip', filename)
+        self.assertEqual(bucket.keys['export.zip'], self.data)
+        self.assertTrue(etag.endswith('-4'))
+
+    def test_upload_file_deletes_unverified_single_put(self):
+        bucket = FakeBucket(bad_etag='0' * 32)
+        filename = self._write_temp_file(self.data[:50])
+        self.assertRaises(UploadVerificationError, upload_file, bucket, 'export.zip', filename)
+        self.assertEqual(bucket.deleted, ['export.zip'])
+        self.assertNotIn('export.zip', bucket.keys)
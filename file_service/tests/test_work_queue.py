@@ -0,0 +1,107 @@
+import threading
+import time
+import unittest
+
+from file_service.work_queue import InMemoryRedis, LeaseLostError, WorkQueue
+
+
+class WorkQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = WorkQueue(InMemoryRedis(), 'test', lease_seconds=60, max_attempts=2)
+
+    def _pop_all_finished(self):
+        finished = []
+        while True:
+            item = self.queue.pop_finished()
+            if item is None:
+                return finished
+            finished.append(item)
+
+    def test_claims_in_order_and_finishes(self):
+        self.queue.enqueue(['a', 'b'])
+        self.assertEqual(self.queue.claim('w1'), 'a')
+        self.assertEqual(self.queue.claim('w2'), 'b')
+        self.assertIsNone(self.queue.claim('w3'))
+        self.assertFalse(self.queue.is_drained())
+
+        self.queue.complete('a', 'w1')
+        self.queue.complete('b', 'w2')
+        self.assertTrue(self.queue.is_drained())
+        self.assertEqual(self._pop_all_finished(), [('a', True), ('b', True)])
+
+    def test_expired_lease_is_requeued(self):
+        self.queue.lease_seconds = 0
+        self.queue.enqueue(['a'])
+        self.assertEqual(self.queue.claim('w1'), 'a')
+        time.sleep(0.01)
+
+        self.assertEqual(self.queue.claim('w2'), 'a')
+        self.assertFalse(self.queue.renew('a', 'w1'))
+        # The result of the worker that lost the lease is ignored
+        self.queue.complete('a', 'w1')
+        self.assertEqual(self._pop_all_finished(), [])
+
+        self.queue.lease_seconds = 60
+        self.assertTrue(self.queue.renew('a', 'w2'))
+        self.queue.complete('a', 'w2')
+        self.assertEqual(self._pop_all_finished(), [('a', True)])
+        self.assertTrue(self.queue.is_drained())
+
+    def test_failed_after_max_attempts(self):
+        self.queue.enqueue(['a'])
+        self.assertEqual(self.queue.claim('w1'), 'a')
+        self.queue.fail('a', 'w1', 'first')
+        self.assertEqual(self.queue.get_stats()['pending'], 1)
+
+        self.assertEqual(self.queue.claim('w1'), 'a')
+        self.queue.fail('a', 'w1', 'second')
+        self.assertTrue(self.queue.is_drained())
+        self.assertEqual(self._pop_all_finished(), [('a', False)])
+        self.assertEqual(self.queue.client.hget(self.queue.failed_key, 'a'), 'second')
+
+    def test_expired_lease_counts_as_attempt(self):
+        self.queue.lease_seconds = 0
+        self.queue.enqueue(['a'])
+        self.assertEqual(self.queue.claim('w1'), 'a')
+        time.sleep(0.01)
+        self.assertEqual(self.queue.claim('w2'), 'a')
+        time.sleep(0.01)
+
+        self.assertIsNone(self.queue.claim('w3'))
+        self.assertTrue(self.queue.is_drained())
+        self.assertEqual(self._pop_all_finished(), [('a', False)])
+
+    def test_concurrent_workers_claim_each_keyword_once(self):
+        keywords = [str(i) for i in range(100)]
+        self.queue.enqueue(keywords)
+        claimed = []
+        lock = threading.Lock()
+
+        def work(worker_id):
+            while True:
+                keyword = self.queue.claim(worker_id)
+                if keyword is None:
+                    return
+                with lock:
+                    claimed.append(keyword)
+                self.queue.complete(keyword, worker_id)
+
+        threads = [threading.Thread(target=work, args=('w%d' % n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), sorted(keywords))
+        self.assertTrue(self.queue.is_drained())
+
+    def test_heartbeat_reports_lost_lease(self):
+        self.queue.lease_seconds = 0.03
+        self.queue.enqueue(['a'])
+        self.assertEqual(self.queue.claim('w1'), 'a')
+        # Another worker takes the keyword over, so the next renewal fails
+        self.queue.client.hset(self.queue.leases_key, 'a', '["w2", %f]' % (time.time() + 60))
+        with self.queue.heartbeat('a', 'w1') as heartbeat:
+            time.sleep(0.1)
+        self.assertTrue(heartbeat.lost)
+        self.assertRaises(LeaseLostError, heartbeat.check)
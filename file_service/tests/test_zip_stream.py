@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import unittest
+import zipfile
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+from file_service import zip_stream
+from file_service.zip_stream import ZIP_DEFLATED, ZIP_STORED, ZipStreamWriter
+
+
+class WriteOnlyFile(object):
+    """
+    Output stream without seek() or tell(), like an S3 multipart upload
+    """
+
+    def __init__(self):
+        self._buffer = BytesIO()
+
+    def write(self, data):
+        self._buffer.write(data)
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+
+class ZipStreamWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.text = b'iSites file export\n' * 5000
+        self.binary = os.urandom(100000)
+
+    def _write_archive(self, **kwargs):
+        out = WriteOnlyFile()
+        z_file = ZipStreamWriter(out, checksums=('md5',), **kwargs)
+        z_file.write_str('README.html', b'<p>readme</p>', compress_type=ZIP_DEFLATED)
+        z_file.write_fileobj('topic/notes.txt', BytesIO(self.text), compress_type=ZIP_DEFLATED,
+                             size_hint=len(self.text), chunk_size=4096)
+        z_file.write_fileobj('topic/no_hint.txt', BytesIO(self.text), compress_type=ZIP_DEFLATED, chunk_size=4096)
+        z_file.write_fileobj('topic/image.jpg', BytesIO(self.binary), compress_type=ZIP_STORED, chunk_size=4096)
+        z_file.write_fileobj('topic/empty.txt', BytesIO(b''), compress_type=ZIP_DEFLATED)
+        z_file.write_str(u'topic/r\xe9sum\xe9.txt', b'unicode name', compress_type=ZIP_STORED)
+        z_file.close()
+        return out.getvalue(), z_file
+
+    def _check_archive(self, data, z_file):
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('README.html'), b'<p>readme</p>')
+            self.assertEqual(archive.read('topic/notes.txt'), self.text)
+            self.assertEqual(archive.read('topic/no_hint.txt'), self.text)
+            self.assertEqual(archive.read('topic/image.jpg'), self.binary)
+            self.assertEqual(archive.read('topic/empty.txt'), b'')
+            self.assertEqual(archive.read(u'topic/r\xe9sum\xe9.txt'), b'unicode name')
+
+            infos = dict((info.filename, info) for info in archive.infolist())
+            self.assertEqual(infos['topic/notes.txt'].compress_type, zipfile.ZIP_DEFLATED)
+            self.assertLess(infos['topic/notes.txt'].compress_size, len(self.text))
+            self.assertEqual(infos['topic/image.jpg'].compress_type, zipfile.ZIP_STORED)
+            self.assertTrue(infos[u'topic/r\xe9sum\xe9.txt'].flag_bits & 0x800)
+            for info in archive.infolist():
+                # Every entry is followed by a data descriptor
+                self.assertTrue(info.flag_bits & 0x08)
+
+        self.assertEqual(z_file.offset, len(data))
+        self.assertEqual(z_file.archive_checksums['md5'], hashlib.md5(data).hexdigest())
+        entries = dict((entry.filename, entry) for entry in z_file.entries)
+        self.assertTrue(entries['topic/no_hint.txt'].zip64)
+        self.assertFalse(entries['topic/notes.txt'].zip64)
+        self.assertEqual(entries['topic/notes.txt'].checksums['md5'], hashlib.md5(self.text).hexdigest())
+
+    def test_round_trip(self):
+        data, z_file = self._write_archive()
+        self._check_archive(data, z_file)
+
+    def test_round_trip_with_deflate_pool(self):
+        pool = ThreadPool(3)
+        try:
+            data, z_file = self._write_archive(deflate_pool=pool, deflate_window=2)
+        finally:
+            pool.close()
+            pool.join()
+        # The chunks deflated independently in the pool must splice into one valid deflate stream per entry
+        self._check_archive(data, z_file)
+
+    def test_write_payload_reuses_compressed_data(self):
+        out = WriteOnlyFile()
+        z_file = ZipStreamWriter(out)
+        payload = BytesIO()
+        entry = z_file.write_fileobj('a.txt', BytesIO(self.text), compress_type=ZIP_DEFLATED,
+                                     size_hint=len(self.text), payload_sink=payload)
+        payload.seek(0)
+        reused = z_file.write_payload('b.txt', payload, entry.crc, entry.file_size, entry.compress_size,
+                                      entry.compress_type, checksums=entry.checksums)
+        z_file.close()
+
+        self.assertTrue(reused.reused)
+        self.assertEqual(reused.checksums, entry.checksums)
+        with zipfile.ZipFile(BytesIO(out.getvalue())) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('b.txt'), self.text)
+
+    def test_zip64_end_of_central_directory(self):
+        file_count_limit = zip_stream.ZIP_FILECOUNT_LIMIT
+        # Lowered so a few entries need the ZIP64 end of central directory record and locator
+        zip_stream.ZIP_FILECOUNT_LIMIT = 2
+        try:
+            out = WriteOnlyFile()
+            z_file = ZipStreamWriter(out)
+            for n in range(3):
+                z_file.write_str('file%d.txt' % n, b'data %d' % n)
+            z_file.close()
+        finally:
+            zip_stream.ZIP_FILECOUNT_LIMIT = file_count_limit
+
+        data = out.getvalue()
+        self.assertIn(b'PK\x06\x06', data)
+        self.assertIn(b'PK\x06\x07', data)
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            self.assertEqual(archive.namelist(), ['file0.txt', 'file1.txt', 'file2.txt'])
+            self.assertEqual(archive.read('file2.txt'), b'data 2')
@@ -0,0 +1,372 @@
+"""
+Redis backed queue of keywords shared by export workers on several hosts.
+
+A single export_files process is limited by the NFS and network bandwidth of its host. With a WorkQueue, keywords are
+enqueued once and every host that mounts the storage nodes runs export_files --from_queue to claim and export them.
+A claimed keyword is leased to its worker, which renews the lease with heartbeats while it exports. When a worker dies,
+its lease expires and the keyword is put back on the queue for another worker, up to WORK_QUEUE_MAX_ATTEMPTS times.
+
+Claims and lease changes are WATCH/MULTI transactions, so two workers never claim the same keyword at the same time.
+InMemoryRedis implements the few Redis commands used here, for trying the queue without a Redis server.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from redis.exceptions import WatchError
+
+from file_service.clients import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'isites_migration:work_queue'
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+def get_work_queue(name=None, client=None):
+    """
+    Returns the WorkQueue called name, WORK_QUEUE_NAME by default, in the Redis at REDIS_HOST unless another client
+    such as an InMemoryRedis is given
+    """
+    return WorkQueue(
+        client or get_redis(),
+        name or settings.WORK_QUEUE_NAME,
+        settings.WORK_QUEUE_LEASE_SECONDS,
+        settings.WORK_QUEUE_MAX_ATTEMPTS
+    )
+
+
+class WorkQueue(object):
+    """
+    Keywords waiting in the pending list are claimed by workers, which hold a lease on them in the leases hash until
+    they complete or fail them. Finished keywords are added to the finished list, which migrate_files reads to import
+    them, and keywords that failed every attempt are also recorded in the failed hash.
+    """
+
+    def __init__(self, client, name, lease_seconds, max_attempts):
+        self.client = client
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(max_attempts, 1)
+        prefix = "%s:%s" % (KEY_PREFIX, name)
+        self.pending_key = prefix + ':pending'
+        self.leases_key = prefix + ':leases'
+        self.attempts_key = prefix + ':attempts'
+        self.finished_key = prefix + ':finished'
+        self.failed_key = prefix + ':failed'
+
+    def enqueue(self, keywords):
+        if keywords:
+            self.client.rpush(self.pending_key, *keywords)
+        logger.info("Enqueued %d keywords on work queue %s", len(keywords), self.name)
+
+    def clear(self):
+        self.client.delete(self.pending_key, self.leases_key, self.attempts_key, self.finished_key, self.failed_key)
+
+    def claim(self, worker_id):
+        """
+        Leases the next pending keyword to worker_id and returns it, or returns None if nothing is pending. Expired
+        leases are re-queued first.
+        """
+        return self._transaction(self._claim, worker_id)
+
+    def renew(self, keyword, worker_id):
+        """
+        Extends worker_id's lease on keyword, returning False if the lease expired and the keyword was re-queued
+        """
+        return self._transaction(self._renew, keyword, worker_id)
+
+    def complete(self, keyword, worker_id):
+        self._transaction(self._finish, keyword, worker_id, True, None)
+
+    def fail(self, keyword, worker_id, error):
+        self._transaction(self._finish, keyword, worker_id, False, error)
+
+    def heartbeat(self, keyword, worker_id):
+        return LeaseHeartbeat(self, keyword, worker_id)
+
+    def pop_finished(self):
+        """
+        Returns the next (keyword, exported) pair from the finished list, or None if it is empty
+        """
+        item = self.client.lpop(self.finished_key)
+        if item is None:
+            return None
+        keyword, exported = json.loads(item)
+        return keyword, exported
+
+    def is_drained(self):
+        """
+        Whether no keywords are pending or leased
+        """
+        return not self.client.llen(self.pending_key) and not self.client.hlen(self.leases_key)
+
+    def get_stats(self):
+        return {
+            'pending': self.client.llen(self.pending_key),
+            'leased': self.client.hlen(self.leases_key),
+            'finished': self.client.llen(self.finished_key),
+            'failed': self.client.hlen(self.failed_key),
+        }
+
+    def _transaction(self, func, *args):
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(self.pending_key, self.leases_key)
+                    return func(pipe, *args)
+                except WatchError:
+                    logger.debug("Work queue %s changed during a transaction, retrying", self.name)
+
+    def _claim(self, pipe, worker_id):
+        now = time.time()
+        requeued = []
+        abandoned = []
+        for keyword, lease in pipe.hgetall(self.leases_key).items():
+            owner, expires = json.loads(lease)
+            if expires >= now:
+                continue
+            logger.warning("Lease of worker %s on keyword %s expired on work queue %s", owner, keyword, self.name)
+            # A keyword whose workers keep dying is given up on like one whose export keeps failing
+            if int(pipe.hget(self.attempts_key, keyword) or 0) < self.max_attempts:
+                requeued.append(keyword)
+            else:
+                abandoned.append(keyword)
+        keyword = pipe.lindex(self.pending_key, 0)
+        if keyword is None and requeued:
+            keyword = requeued[0]
+        attempts = int(pipe.hget(self.attempts_key, keyword) or 0) if keyword is not None else 0
+
+        pipe.multi()
+        for expired_keyword in requeued:
+            pipe.hdel(self.leases_key, expired_keyword)
+            pipe.rpush(self.pending_key, expired_keyword)
+        for expired_keyword in abandoned:
+            self._record_failed(pipe, expired_keyword, 'Lease expired on every attempt')
+        if keyword is not None:
+            pipe.lpop(self.pending_key)
+            pipe.hset(self.leases_key, keyword, json.dumps([worker_id, now + self.lease_seconds]))
+            pipe.hincrby(self.attempts_key, keyword, 1)
+        pipe.execute()
+
+        if keyword is not None:
+            logger.info(
+                "Worker %s claimed keyword %s from work queue %s (attempt %d)",
+                worker_id,
+                keyword,
+                self.name,
+                attempts + 1
+            )
+        return keyword
+
+    def _renew(self, pipe, keyword, worker_id):
+        lease = pipe.hget(self.leases_key, keyword)
+        if lease is None or json.loads(lease)[0] != worker_id:
+            return False
+        pipe.multi()
+        pipe.hset(self.leases_key, keyword, json.dumps([worker_id, time.time() + self.lease_seconds]))
+        pipe.execute()
+        return True
+
+    def _finish(self, pipe, keyword, worker_id, exported, error):
+        lease = pipe.hget(self.leases_key, keyword)
+        if lease is not None and json.loads(lease)[0] != worker_id:
+            # The lease expired and another worker has the keyword now, its result is the one that counts
+            logger.warning("Worker %s lost its lease on keyword %s, ignoring its result", worker_id, keyword)
+            pipe.reset()
+            return
+        if lease is None and not exported:
+            # Already re-queued when the lease expired
+            pipe.reset()
+            return
+        attempts = int(pipe.hget(self.attempts_key, keyword) or 0)
+
+        pipe.multi()
+        pipe.hdel(self.leases_key, keyword)
+        if exported:
+            # Its lease may have expired and put it back on the pending list, there is no need to export it again
+            pipe.lrem(self.pending_key, 0, keyword)
+            pipe.hdel(self.attempts_key, keyword)
+            pipe.rpush(self.finished_key, json.dumps([keyword, True]))
+        elif attempts < self.max_attempts:
+            logger.warning(
+                "Export of keyword %s failed on attempt %d of %d, re-queueing it on work queue %s",
+                keyword,
+                attempts,
+                self.max_attempts,
+                self.name
+            )
+            pipe.rpush(self.pending_key, keyword)
+        else:
+            self._record_failed(pipe, keyword, error)
+        pipe.execute()
+
+    def _record_failed(self, pipe, keyword, error):
+        pipe.hdel(self.leases_key, keyword)
+        pipe.hdel(self.attempts_key, keyword)
+        pipe.hset(self.failed_key, keyword, error or '')
+        pipe.rpush(self.finished_key, json.dumps([keyword, False]))
+
+
+class LeaseHeartbeat(object):
+    """
+    Renews a lease from a background thread every third of the lease time while the with block runs
+    """
+
+    def __init__(self, queue, keyword, worker_id):
+        self.queue = queue
+        self.keyword = keyword
+        self.worker_id = worker_id
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="heartbeat-%s" % self.keyword)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+    def check(self):
+        """
+        Raises LeaseLostError if the lease expired and the keyword may have been claimed by another worker
+        """
+        if self.lost:
+            raise LeaseLostError("Worker %s lost its lease on keyword %s" % (self.worker_id, self.keyword))
+
+    def _run(self):
+        interval = self.queue.lease_seconds / 3.0
+        while not self._stopped.wait(interval):
+            try:
+                if not self.queue.renew(self.keyword, self.worker_id):
+                    logger.warning("Worker %s lost its lease on keyword %s", self.worker_id, self.keyword)
+                    self.lost = True
+                    return
+            except Exception:
+                logger.exception("Failed to renew lease of worker %s on keyword %s", self.worker_id, self.keyword)
+
+
+class InMemoryRedis(object):
+    """
+    In-process stand-in for the Redis commands WorkQueue uses. A watched pipeline holds a lock until it is executed
+    or reset, so transactions are serialized and never need retrying.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    def pipeline(self):
+        return InMemoryPipeline(self)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def rpush(self, key, *values):
+        with self._lock:
+            items = self._data.setdefault(key, [])
+            items.extend(values)
+            return len(items)
+
+    def lpop(self, key):
+        with self._lock:
+            items = self._data.get(key)
+            return items.pop(0) if items else None
+
+    def lrem(self, key, count, value):
+        with self._lock:
+            items = self._data.get(key) or []
+            matches = [i for i, item in enumerate(items) if item == value]
+            if count > 0:
+                matches = matches[:count]
+            elif count < 0:
+                matches = matches[count:]
+            for i in reversed(matches):
+                del items[i]
+            return len(matches)
+
+    def lindex(self, key, index):
+        with self._lock:
+            items = self._data.get(key) or []
+            return items[index] if -len(items) <= index < len(items) else None
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._data.get(key) or [])
+
+    def hget(self, key, field):
+        with self._lock:
+            return (self._data.get(key) or {}).get(field)
+
+    def hset(self, key, field, value):
+        with self._lock:
+            self._data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            values = self._data.get(key) or {}
+            for field in fields:
+                values.pop(field, None)
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._data.get(key) or {})
+
+    def hlen(self, key):
+        with self._lock:
+            return len(self._data.get(key) or {})
+
+    def hincrby(self, key, field, amount=1):
+        with self._lock:
+            values = self._data.setdefault(key, {})
+            values[field] = int(values.get(field) or 0) + amount
+            return values[field]
+
+
+class InMemoryPipeline(object):
+    """
+    Runs commands straight away, holding the InMemoryRedis lock from watch() until execute() or reset()
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._locked = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def watch(self, *keys):
+        if not self._locked:
+            self.client._lock.acquire()
+            self._locked = True
+
+    def multi(self):
+        pass
+
+    def execute(self):
+        self.reset()
+        return []
+
+    def reset(self):
+        if self._locked:
+            self._locked = False
+            self.client._lock.release()
@@ -0,0 +1,388 @@
+"""
+Write-only zip archives for non-seekable output streams.
+
+zipfile.ZipFile seeks back over each local file header after an entry has been written, so it cannot write to an S3
+multipart upload. ZipStreamWriter writes the CRC and sizes of each entry in a trailing data descriptor instead, and
+switches to ZIP64 records for entries, offsets and central directories that do not fit in the classic 32 bit fields.
+"""
+import hashlib
+import struct
+import time
+import zlib
+from collections import deque
+
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+ZIP64_LIMIT = (1 << 32) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+CHUNK_SIZE = 64 * 1024
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_CREATE_SYSTEM_UNIX = 3
+_EXTERNAL_ATTR_FILE = (0o100644 & 0xFFFF) << 16
+
+_LOCAL_FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_FILE_HEADER_SIGNATURE = b'PK\003\004'
+_DATA_DESCRIPTOR = struct.Struct('<4sL2L')
+_DATA_DESCRIPTOR_ZIP64 = struct.Struct('<4sL2Q')
+_DATA_DESCRIPTOR_SIGNATURE = b'PK\007\010'
+_CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+_CENTRAL_DIR_SIGNATURE = b'PK\001\002'
+_END_ARCHIVE = struct.Struct('<4s4H2LH')
+_END_ARCHIVE_SIGNATURE = b'PK\005\006'
+_END_ARCHIVE_ZIP64 = struct.Struct('<4sQ2H2L4Q')
+_END_ARCHIVE_ZIP64_SIGNATURE = b'PK\006\006'
+_END_ARCHIVE_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_END_ARCHIVE_ZIP64_LOCATOR_SIGNATURE = b'PK\006\007'
+
+
+class ZipStreamError(Exception):
+    pass
+
+
+class ZipStreamEntry(object):
+    """
+    Central directory record for an entry written by ZipStreamWriter
+    """
+
+    def __init__(self, filename, date_time, compress_type, header_offset, zip64):
+        self.filename = filename
+        self.date_time = date_time
+        self.compress_type = compress_type
+        self.header_offset = header_offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.checksums = {}
+        self.reused = False
+
+    @property
+    def encoded_filename(self):
+        if isinstance(self.filename, bytes):
+            return self.filename
+        return self.filename.encode('utf-8')
+
+    @property
+    def flag_bits(self):
+        flag_bits = _FLAG_DATA_DESCRIPTOR
+        try:
+            self.encoded_filename.decode('ascii')
+        except UnicodeDecodeError:
+            flag_bits |= _FLAG_UTF8
+        return flag_bits
+
+    @property
+    def dos_date(self):
+        year, month, day = self.date_time[:3]
+        return (max(year, 1980) - 1980) << 9 | month << 5 | day
+
+    @property
+    def dos_time(self):
+        hour, minute, second = self.date_time[3:6]
+        return hour << 11 | minute << 5 | second // 2
+
+
+def deflate_chunk(data, compress_level, last):
+    """
+    Deflates one chunk of an entry independently of the others. Chunks other than the last end with a sync flush on a
+    byte boundary, so the outputs can be concatenated into a single valid deflate stream. Returns the deflated data and
+    the time spent.
+    """
+    start = time.time()
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return deflated, time.time() - start
+
+
+class ZipStreamWriter(object):
+    """
+    Writes a zip archive sequentially to fileobj, which only needs to provide write(). Entries are written one at a
+    time and the central directory is written by close().
+
+    If deflate_pool (a multiprocessing.pool.ThreadPool) is given, the chunks of deflated entries are compressed in its
+    threads, with at most deflate_window chunks in flight. zlib releases the GIL while compressing.
+
+    checksums names hashlib algorithms, such as md5 and sha256, computed over the uncompressed data of each entry and
+    over the whole archive as it is written. They are returned as hex digests in ZipStreamEntry.checksums, alongside
+    the crc32, and in archive_checksums.
+    """
+
+    def __init__(self, fileobj, compress_type=ZIP_STORED, compress_level=zlib.Z_DEFAULT_COMPRESSION,
+                 deflate_pool=None, deflate_window=4, checksums=()):
+        self.fileobj = fileobj
+        self.checksums = tuple(checksums)
+        self._archive_hashes = [(name, hashlib.new(name)) for name in self.checksums]
+        self.compress_type = compress_type
+        self.compress_level = compress_level
+        self.deflate_pool = deflate_pool
+        self.deflate_window = max(deflate_window, 1)
+        self.entries = []
+        self.offset = 0
+        self.compress_time = 0.0
+        self.closed = False
+
+    @property
+    def deflated_entries(self):
+        return [entry for entry in self.entries if entry.compress_type == ZIP_DEFLATED]
+
+    @property
+    def archive_checksums(self):
+        """
+        Hex digests of everything written so far, the complete archive once close() has been called
+        """
+        return dict((name, h.hexdigest()) for name, h in self._archive_hashes)
+
+    def write_str(self, arcname, data, date_time=None, compress_type=None):
+        """
+        Writes the byte string data to the archive as arcname
+        """
+        entry = self._start_entry(arcname, date_time, compress_type, len(data))
+        self._write_entry_data(entry, iter([data]))
+        return entry
+
+    def write_fileobj(self, arcname, fileobj, date_time=None, compress_type=None, size_hint=None, chunk_size=CHUNK_SIZE,
+                      payload_sink=None):
+        """
+        Copies the contents of the open file object fileobj to the archive as arcname. size_hint is the expected
+        uncompressed size of the entry, entries without a size hint or over 4 GB are written with ZIP64 headers.
+        The (possibly compressed) entry data is also written to payload_sink if one is given, so it can be reused
+        with write_payload().
+        """
+        entry = self._start_entry(arcname, date_time, compress_type, size_hint)
+        self._write_entry_data(entry, iter(lambda: fileobj.read(chunk_size), b''), payload_sink)
+        return entry
+
+    def write_payload(self, arcname, fileobj, crc, file_size, compress_size, compress_type, date_time=None,
+                      chunk_size=CHUNK_SIZE, checksums=None):
+        """
+        Writes an entry whose data was already compressed for another entry, copying the payload from fileobj as-is.
+        checksums are the ZipStreamEntry.checksums of that entry.
+        """
+        entry = self._start_entry(arcname, date_time, compress_type, max(file_size, compress_size))
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            entry.compress_size += len(chunk)
+            self._write(chunk)
+        if entry.compress_size != compress_size:
+            raise ZipStreamError("Payload for %s is %d bytes, expected %d" % (
+                entry.filename, entry.compress_size, compress_size
+            ))
+        entry.crc = crc
+        entry.file_size = file_size
+        entry.checksums = dict(checksums or {}, crc32="%08x" % crc)
+        entry.reused = True
+        self._finish_entry(entry)
+        return entry
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        central_dir_offset = self.offset
+        for entry in self.entries:
+            self._write_central_dir_record(entry)
+        central_dir_size = self.offset - central_dir_offset
+
+        entry_count = len(self.entries)
+        if (entry_count > ZIP_FILECOUNT_LIMIT or central_dir_offset > ZIP64_LIMIT or
+                central_dir_size > ZIP64_LIMIT):
+            zip64_end_offset = self.offset
+            self._write(_END_ARCHIVE_ZIP64.pack(
+                _END_ARCHIVE_ZIP64_SIGNATURE,
+                _END_ARCHIVE_ZIP64.size - 12,
+                _VERSION_ZIP64,
+                _VERSION_ZIP64,
+                0,
+                0,
+                entry_count,
+                entry_count,
+                central_dir_size,
+                central_dir_offset
+            ))
+            self._write(_END_ARCHIVE_ZIP64_LOCATOR.pack(_END_ARCHIVE_ZIP64_LOCATOR_SIGNATURE, 0, zip64_end_offset, 1))
+            entry_count = min(entry_count, ZIP_FILECOUNT_LIMIT)
+            central_dir_offset = min(central_dir_offset, ZIP64_LIMIT)
+            central_dir_size = min(central_dir_size, ZIP64_LIMIT)
+
+        self._write(_END_ARCHIVE.pack(
+            _END_ARCHIVE_SIGNATURE,
+            0,
+            0,
+            entry_count,
+            entry_count,
+            central_dir_size,
+            central_dir_offset,
+            0
+        ))
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+        for _, h in self._archive_hashes:
+            h.update(data)
+
+    def _start_entry(self, arcname, date_time, compress_type, size_hint):
+        if self.closed:
+            raise ZipStreamError("Cannot write %s to a closed archive" % arcname)
+        if compress_type is None:
+            compress_type = self.compress_type
+        zip64 = size_hint is None or size_hint > ZIP64_LIMIT
+        date_time = date_time or time.localtime()[:6]
+        entry = ZipStreamEntry(arcname.lstrip('/'), date_time, compress_type, self.offset, zip64)
+
+        filename = entry.encoded_filename
+        extra = b''
+        if zip64:
+            extra = struct.pack('<2H2Q', 1, 16, 0, 0)
+            size = ZIP64_LIMIT
+        else:
+            size = 0
+        self._write(_LOCAL_FILE_HEADER.pack(
+            _LOCAL_FILE_HEADER_SIGNATURE,
+            _VERSION_ZIP64 if zip64 else _VERSION_DEFAULT,
+            0,
+            entry.flag_bits,
+            entry.compress_type,
+            entry.dos_time,
+            entry.dos_date,
+            0,
+            size,
+            size,
+            len(filename),
+            len(extra)
+        ))
+        self._write(filename)
+        self._write(extra)
+        self.entries.append(entry)
+        return entry
+
+    def _write_entry_data(self, entry, chunks, payload_sink=None):
+        chunks = (chunk for chunk in chunks if chunk)
+        if entry.compress_type == ZIP_DEFLATED:
+            if self.deflate_pool is not None:
+                pieces = self._deflate_in_pool(chunks)
+            else:
+                pieces = self._deflate(chunks)
+        elif entry.compress_type == ZIP_STORED:
+            pieces = ((chunk, chunk) for chunk in chunks)
+        else:
+            raise ZipStreamError("Unsupported compression type %s for %s" % (entry.compress_type, entry.filename))
+
+        crc = 0
+        hashes = [(name, hashlib.new(name)) for name in self.checksums]
+        for chunk, data in pieces:
+            crc = zlib.crc32(chunk, crc)
+            for _, h in hashes:
+                h.update(chunk)
+            entry.file_size += len(chunk)
+            entry.compress_size += len(data)
+            self._write(data)
+            if payload_sink is not None:
+                payload_sink.write(data)
+        entry.crc = crc & 0xFFFFFFFF
+        entry.checksums = dict((name, h.hexdigest()) for name, h in hashes)
+        entry.checksums['crc32'] = "%08x" % entry.crc
+        self._finish_entry(entry)
+
+    def _finish_entry(self, entry):
+        if entry.zip64:
+            self._write(_DATA_DESCRIPTOR_ZIP64.pack(
+                _DATA_DESCRIPTOR_SIGNATURE, entry.crc, entry.compress_size, entry.file_size
+            ))
+        elif entry.file_size > ZIP64_LIMIT or entry.compress_size > ZIP64_LIMIT:
+            raise ZipStreamError("%s is larger than its size hint and would require ZIP64 headers" % entry.filename)
+        else:
+            self._write(_DATA_DESCRIPTOR.pack(
+                _DATA_DESCRIPTOR_SIGNATURE, entry.crc, entry.compress_size, entry.file_size
+            ))
+
+    def _deflate(self, chunks):
+        """
+        Yields (chunk, deflated data) pairs, deflating on the calling thread
+        """
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for chunk in chunks:
+            start = time.time()
+            data = compressor.compress(chunk)
+            self.compress_time += time.time() - start
+            yield chunk, data
+        start = time.time()
+        data = compressor.flush()
+        self.compress_time += time.time() - start
+        yield b'', data
+
+    def _deflate_in_pool(self, chunks):
+        """
+        Yields (chunk, deflated data) pairs in order, deflating up to deflate_window chunks at a time in deflate_pool
+        """
+        pending = deque()
+        next_chunk = next(chunks, None)
+        if next_chunk is None:
+            data, elapsed = deflate_chunk(b'', self.compress_level, True)
+            self.compress_time += elapsed
+            yield b'', data
+            return
+
+        while next_chunk is not None or pending:
+            while next_chunk is not None and len(pending) < self.deflate_window:
+                chunk = next_chunk
+                next_chunk = next(chunks, None)
+                pending.append((chunk, self.deflate_pool.apply_async(
+                    deflate_chunk,
+                    (chunk, self.compress_level, next_chunk is None)
+                )))
+            chunk, result = pending.popleft()
+            data, elapsed = result.get()
+            self.compress_time += elapsed
+            yield chunk, data
+
+    def _write_central_dir_record(self, entry):
+        zip64_fields = []
+        file_size = entry.file_size
+        compress_size = entry.compress_size
+        header_offset = entry.header_offset
+        if file_size > ZIP64_LIMIT:
+            zip64_fields.append(file_size)
+            file_size = ZIP64_LIMIT
+        if compress_size > ZIP64_LIMIT:
+            zip64_fields.append(compress_size)
+            compress_size = ZIP64_LIMIT
+        if header_offset > ZIP64_LIMIT:
+            zip64_fields.append(header_offset)
+            header_offset = ZIP64_LIMIT
+
+        extra = b''
+        if zip64_fields:
+            extra = struct.pack('<2H%dQ' % len(zip64_fields), 1, 8 * len(zip64_fields), *zip64_fields)
+        version = _VERSION_ZIP64 if zip64_fields or entry.zip64 else _VERSION_DEFAULT
+
+        filename = entry.encoded_filename
+        self._write(_CENTRAL_DIR.pack(
+            _CENTRAL_DIR_SIGNATURE,
+            version,
+            _CREATE_SYSTEM_UNIX,
+            version,
+            0,
+            entry.flag_bits,
+            entry.compress_type,
+            entry.dos_time,
+            entry.dos_date,
+            entry.crc,
+            compress_size,
+            file_size,
+            len(filename),
+            len(extra),
+            0,
+            0,
+            0,
+            _EXTERNAL_ATTR_FILE,
+            header_offset
+        ))
+        self._write(filename)
+        self._write(extra)
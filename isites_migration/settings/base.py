@@ -168,6 +168,34 @@ ICOMMONS_COMMON = {
 EXPORT_DIR = SECURE_SETTINGS.get('export_dir', os.path.join(BASE_DIR, 'export'))
 EXPORT_FILES_README_FILENAME = '_ReadMe_About_Your_iSites_Archive.html'
 CANVAS_IMPORT_FOLDER_PREFIX = 'unpublished_isites_archive_'
+CANVAS_IMPORT_POLL_THREADS = 8  # Canvas content migration progress URLs polled concurrently by import_files
+CANVAS_IMPORT_POLL_MIN_INTERVAL = 2  # Seconds between polls of a content migration that has just started
+CANVAS_IMPORT_POLL_MAX_INTERVAL = 60  # Longest time in seconds between polls of a long running content migration
+CANVAS_IMPORT_POLL_MAX_ERRORS = 10  # Failed polls in a row after which a content migration is counted as failed
+CANVAS_IMPORT_MAX_IN_FLIGHT = 50  # Canvas content migrations import_files keeps running at once
+CANVAS_IMPORT_RATE_LIMIT_LOW_WATER = 300  # Below this X-Rate-Limit-Remaining, import_files spaces out submissions
+CANVAS_IMPORT_RATE_LIMIT_MAX_DELAY = 30  # Longest pause in seconds between submissions, and the pause after a 403
+MIGRATION_JOB_STORE = os.path.join(EXPORT_DIR, 'migration_jobs.sqlite3')  # Job state for --resume, None disables it
+MIGRATE_FILES_QUEUE_SIZE = 20  # Exported keywords waiting for import before migrate_files --pipeline pauses exports
+WORK_QUEUE_REDIS_DB = 1  # Redis database at REDIS_HOST holding the work queues, apart from the cache in database 0
+WORK_QUEUE_NAME = 'export_files'  # Default --queue_name
+WORK_QUEUE_LEASE_SECONDS = 300  # A claimed keyword is re-queued once its worker has missed heartbeats for this long
+WORK_QUEUE_MAX_ATTEMPTS = 3  # Claims of a keyword before it is recorded as failed
+WORK_QUEUE_POLL_INTERVAL = 5  # Seconds between checks of a work queue with nothing to claim or nothing finished
+
+EXPORT_FILES_WORKERS = 1  # Keywords exported concurrently for --term_id and --csv batches
+EXPORT_FILES_READ_BUFFER_SIZE = 1024 * 1024  # Chunk size used to read and decode file node sources
+EXPORT_FILES_SOURCE_BUFFER_SIZE = 16 * 1024 * 1024  # File nodes up to this size are read whole before compressing
+EXPORT_FILES_GZIP_PROCESSES = 2  # Worker processes decoding large gzip file nodes, 0 decodes everything in-thread
+EXPORT_FILES_GZIP_PROCESS_MIN_SIZE = 8 * 1024 * 1024  # Gzip file nodes at least this big are decoded in a worker
+EXPORT_FILES_COMPRESS_LEVEL = 6  # zlib level for archive entries that are not already compressed
+EXPORT_FILES_DEFLATE_THREADS = 4  # Threads deflating archive entries, 0 deflates on the export thread
+EXPORT_FILES_CONTENT_CACHE_BYTES = 10 * 1024 * 1024 * 1024  # Blob payload cache per export process, 0 disables it
+EXPORT_FILES_CHECKSUMS = ['md5', 'sha256']  # hashlib digests recorded per file and archive in the export manifest
+EXPORT_FILES_MAX_ARCHIVE_BYTES = 0  # Keywords bigger than this are split into several archives, 0 disables splitting
+EXPORT_FILES_STORAGE_NODE_CONCURRENCY = 4  # Concurrent file reads per storage node, 0 for no limit
+EXPORT_FILES_STORAGE_NODE_CONCURRENCY_LIMITS = {}  # Per storage node overrides, keyed by StorageNode physical_location
+EXPORT_FILES_STORAGE_NODE_STATS_INTERVAL = 60  # Seconds between per storage node queue and throughput log lines
 
 EXPORT_FILES_EXCLUDED_TOOL_IDS = [10384]  # PROD tool IDs
 EXPORT_FILES_EXCLUDED_TOPIC_TITLES = [
@@ -176,12 +204,21 @@ EXPORT_FILES_EXCLUDED_TOPIC_TITLES = [
 ]
 # SLIDE_TOOL_ID = 11804  # QA tool ID
 SLIDE_TOOL_ID = 10864  # PROD tool ID
+EXPORT_SLIDE_TOOL_WORKERS = 1  # Keywords exported concurrently by export_slide_tool for --term_id and --csv batches
+EXPORT_SLIDE_TOOL_UPLOAD_THREADS = 8  # Images uploaded concurrently for each keyword by export_slide_tool
 
 AWS_ACCESS_KEY_ID = SECURE_SETTINGS.get('aws_access_key_id')
 AWS_ACCESS_KEY = SECURE_SETTINGS.get('aws_access_key')
-AWS_EXPORT_DOWNLOAD_TIMEOUT_SECONDS = 60
+AWS_EXPORT_DOWNLOAD_TIMEOUT_SECONDS = 4 * 60 * 60  # Canvas downloads the archive when its migration job runs
 AWS_EXPORT_BUCKET_SLIDE_TOOL = 'isites-slide-data'
 AWS_EXPORT_BUCKET_ISITES_FILES = 'isites-slide-data'
+AWS_MULTIPART_PART_SIZE = 16 * 1024 * 1024  # S3 requires at least 5 MB for every part except the last
+AWS_MULTIPART_THRESHOLD = 64 * 1024 * 1024  # Files at least this big are uploaded in parts
+AWS_MULTIPART_CONCURRENCY = 4  # Parts in flight per multipart upload
+AWS_UPLOAD_ATTEMPTS = 3  # Attempts per part or single PUT before an upload fails
+AWS_UPLOAD_RETRY_DELAY = 1  # Seconds before the first retry, doubled for each further retry
+AWS_UPLOAD_VERIFY_ETAG = True  # Check S3 ETags against the MD5s of the data sent, disable for SSE-KMS buckets
+AWS_S3_CONNECTION_OPTIONS = {}  # Extra S3Connection arguments, e.g. host, port and is_secure for a local S3 stand-in
 
 _DEFAULT_LOG_LEVEL = SECURE_SETTINGS.get('log_level', 'DEBUG')
 